@@ -1,19 +1,31 @@
 #!/usr/bin/env python3
 import argparse
+import codeop
 import inspect
+import io
+import linecache
+import os
 import re
 import sys
 import tokenize
-import traceback
 import types
 from code import InteractiveConsole
+from collections import ChainMap
 from dataclasses import dataclass
 from enum import Enum
+from functools import lru_cache
+from importlib.util import find_spec
 from pathlib import Path
-from typing import Callable, Optional, Dict, Set, Tuple
+from typing import Callable, Optional, Dict, Set, Tuple, FrozenSet, Sequence
 
 _globals = globals().copy()
 
+# builtins that read the locals of the calling frame
+_locals_accessors = frozenset(('locals', 'vars', 'dir', 'eval', 'exec'))
+
+# low impact monitoring (PEP 669), only available in Python 3.12 and newer
+mon = getattr(sys, 'monitoring', None)
+
 
 @dataclass
 class DbgContinue:
@@ -21,12 +33,77 @@ class DbgContinue:
     """ exit the program? """
 
 
+class ShellNamespace(dict):
+    """
+    Namespace of the shell, contains the variables defined in the shell
+    and looks up everything else in the passed mappings, without copying
+    them, the first mapping wins: ShellNamespace(f_locals, helpers, f_globals)
+
+    It has to be a dict subclass, as exec only accepts dicts as globals,
+    but calls __missing__ for unknown names
+    """
+
+    def __init__(self, *mappings: dict):
+        super().__init__()
+        self._mappings = ChainMap(*mappings)
+
+    def __missing__(self, key):
+        return self._mappings[key]
+
+    def materialize(self) -> "ShellNamespace":
+        """
+        Namespace that contains the names of all but the last mapping
+        (the globals) directly, for shells like bpython that list the names
+        for their completion, the globals are still looked up lazily
+        """
+        *mappings, last = self._mappings.maps
+        namespace = ShellNamespace(last)
+        for mapping in reversed(mappings):
+            namespace.update(mapping)
+        namespace.update(self)
+        return namespace
+
+
+class Store(types.SimpleNamespace):
+    """
+    Store that is shared between shells, supports attribute access
+    (_st.name, for hot loops) and item access (_st["name"])
+    """
+
+    def __getitem__(self, key):
+        return self.__dict__[key]
+
+    def __setitem__(self, key, value):
+        self.__dict__[key] = value
+
+    def __delitem__(self, key):
+        del self.__dict__[key]
+
+    def __contains__(self, key):
+        return key in self.__dict__
+
+
+class CachedCompile:
+    """ codeop.CommandCompiler that caches the code objects of repeated inputs, like context() """
+
+    def __init__(self):
+        self._compile = lru_cache(maxsize=256)(codeop.CommandCompiler())
+
+    def __call__(self, source: str, filename: str = "<input>", symbol: str = "single") -> Optional[types.CodeType]:
+        return self._compile(source, filename, symbol)
+
+
+# shared between all consoles, as there is a new console for every breakpoint
+_cached_compile = CachedCompile()
+
+
 # handles DbgContinue properly
 class CustomInteractiveConsole(InteractiveConsole):
 
     def __init__(self, _locals: dict, filename="<console>"):
         super().__init__(_locals, filename)
         self.locals = _locals
+        self.compile = _cached_compile
 
     def runcode(self, code):
         try:
@@ -37,18 +114,72 @@ class CustomInteractiveConsole(InteractiveConsole):
             self.showtraceback()
 
 
+@lru_cache(maxsize=256)
+def _funcname_regex(funcname: str) -> re.Pattern:
+    return re.compile(r'def\s+' + re.escape(funcname) + r'\s*\(')
+
+
+# the modification time is part of the key, so that changed files are read again
+@lru_cache(maxsize=64)
+def _read_text(path_str: str, mtime: int) -> str:
+    # tokenize.open respects the encoding declaration of the file
+    with tokenize.open(path_str) as fp:
+        return fp.read()
+
+
+# returns a tuple, as the result is shared between all callers
+@lru_cache(maxsize=64)
+def _read_source(path_str: str, mtime: int) -> Tuple[str, ...]:
+    # iterating only splits at newlines (not at form feeds, like
+    # str.splitlines), so the line numbers are the ones of CPython
+    return tuple(line.rstrip("\n") for line in io.StringIO(_read_text(path_str, mtime)))
+
+
+def read_text(path: Path) -> str:
+    """ read the decoded text of a source file, cached as long as the file does not change """
+    return _read_text(str(path), path.stat().st_mtime_ns)
+
+
+def read_source(path: Path) -> Tuple[str, ...]:
+    """ read the lines of a source file, cached as long as the file does not change """
+    return _read_source(str(path), path.stat().st_mtime_ns)
+
+
+# code objects do not change, so their source locations can be cached
+@lru_cache(maxsize=512)
+def _source_file(co: types.CodeType) -> Optional[str]:
+    return inspect.getsourcefile(co)
+
+
+@lru_cache(maxsize=512)
+def _last_line(co: types.CodeType) -> int:
+    """ last line of the code, from the line tables instead of the source """
+    if hasattr(co, "co_lines"):
+        last = max((line for _, _, line in co.co_lines() if line is not None), default=co.co_firstlineno)
+    else:
+        # python < 3.10: co_lnotab pairs of byte and (signed) line increments
+        last = line = co.co_firstlineno
+        for increment in co.co_lnotab[1::2]:
+            line += increment - 0x100 if increment >= 0x80 else increment
+            last = max(last, line)
+    # the lines of nested functions and classes are only part of their own code objects
+    for const in co.co_consts:
+        if isinstance(const, types.CodeType):
+            last = max(last, _last_line(const))
+    return last
+
+
 # based on https://github.com/python/cpython/blob/17a335dd0291d09e1510157a4ebe02932ec632dd/Lib/pdb.py#L97
 def find_function(funcname: str, filename: str) -> Optional[int]:
-    cre = re.compile(r'def\s+%s+\s*[(]' % re.escape(funcname))
+    cre = _funcname_regex(funcname)
     try:
-        fp = tokenize.open(filename)
+        lines = read_source(Path(filename))
     except OSError:
         return None
     # consumer of this info expects the first line to be 1
-    with fp:
-        for lineno, line in enumerate(fp, start=1):
-            if cre.match(line):
-                return lineno
+    for lineno, line in enumerate(lines, start=1):
+        if cre.match(line):
+            return lineno
     return None
 
 
@@ -67,20 +198,161 @@ class StepState:
     mode: StepMode
     frame: types.FrameType
     """current frame"""
+    line: int = -1
+    """line the step started at, when stepping over, repetitions of it (loops on one line) are skipped"""
+    skipped: int = 0
+    """number of skipped repetitions"""
 
 
 class Dbg:
 
     def __init__(self):
         self._main_file: Optional[Path] = None
+        self._main_file_str: Optional[str] = None
+        """ the main file as a string, compared with co_filename without creating Path objects """
         self._skip_count = 0
         self._in_breakpoint = False
-        self._st = {}  # store between evals
+        self._st = Store()  # store between evals
         self.bpython = None
-        # the default code formatter does not highlight the code
+        self._initialized = False
+        """ bpython and pygments are only imported on the first breakpoint """
+        # the default code formatter does not highlight the code,
+        # line numbers start at 1, like the ones of the pygments formatter
         self.code_formatter: Callable[[str, Callable[[int], str]], str] = \
-            lambda code, line_prefix: "\n".join(line_prefix(i) + l
-                                                for i, l in enumerate(code.splitlines()))
+            lambda code, line_prefix: "\n".join([line_prefix(i) + l
+                                                 for i, l in enumerate(code.splitlines(), start=1)])
+        # formatting (and highlighting) is costly, so cache the formatted code snippets
+        self._format_code = lru_cache(maxsize=64)(self._format_code_uncached)
+        # all breakpoint tables are keyed by the file name string (like co_filename),
+        # so that the trace function does not have to create Path objects
+        # file name -> {line numbers of break points}
+        self._breakpoints_in_files: Dict[str, Set[int]] = {}
+        # (file name string, line number) of every breakpoint, the only thing checked per line event,
+        # rebuilt when breakpoints are added or removed
+        self._break_keys: FrozenSet[Tuple[str, int]] = frozenset()
+        # (file name string, line number) -> compiled condition
+        self._breakpoint_conditions: Dict[Tuple[str, int], types.CodeType] = {}
+        # (file name string, line number) -> names used in the condition, None if it might use any local
+        self._breakpoint_condition_names: Dict[Tuple[str, int], Optional[FrozenSet[str]]] = {}
+        # (file name string, line number) -> condition source, as shown to the user
+        self._breakpoint_condition_sources: Dict[Tuple[str, int], str] = {}
+        # file -> {starting numbers of scopes with breakpoints mapped to the breakpoint count}
+        self._scopes_with_breakpoint: Dict[str, Dict[int, int]] = {}
+        # file -> {line number of breakpoint -> starting line number of scope}
+        self._breakpoint_to_scope_start: Dict[str, Dict[int, int]] = {}
+        self._is_first_call = True
+        self._single_step: Optional[StepState] = None
+        """ if true, step into functions when single stepping """
+        self._single_step_instead_of_continue = False
+        self._single_step_instead_of_continue_into = False
+        self._single_step_instead_of_continue_out = False
+        self._interesting_prefixes: Tuple[str, ...] = ()
+        """ prefixes of the file names that step into might step into (main file and breakpoint files) """
+        self._armed = True
+        """ false if there is no breakpoint and no stepping, so that line events can be ignored """
+        self._use_monitoring = mon is not None
+        """ use sys.monitoring instead of sys.settrace, so that only code with breakpoints emits line events """
+        self._current_frame: Optional[types.FrameType] = None
+        """ frame of the current breakpoint """
+        self._helpers = self._create_helpers()
+        """ helpers available in the shell, created only once """
+
+    def _set_breakpoint_condition(self, fn: str, line: int, condition: str):
+        # compile only once, and not on every hit of the breakpoint
+        code = compile(condition, f"<bp:{fn}:{line}>", 'eval')
+        self._breakpoint_conditions[(fn, line)] = code
+        # nested code objects (like comprehensions) use names that are not part of co_names
+        has_nested_code = any(isinstance(c, types.CodeType) for c in code.co_consts)
+        names = frozenset(code.co_names)
+        self._breakpoint_condition_names[(fn, line)] = \
+            None if has_nested_code or not names.isdisjoint(_locals_accessors) else names
+        self._breakpoint_condition_sources[(fn, line)] = condition
+
+    def _remove_breakpoint_condition(self, fn: str, line: int):
+        self._breakpoint_conditions.pop((fn, line), None)
+        self._breakpoint_condition_names.pop((fn, line), None)
+        self._breakpoint_condition_sources.pop((fn, line), None)
+
+    def add_breakpoint(self, file: Path, line: int, scope_start_line: int, condition: Optional[str] = None):
+        fn = str(file)
+        if fn not in self._breakpoints_in_files:
+            self._breakpoints_in_files[fn] = set()
+        if line in self._breakpoints_in_files[fn]:
+            print("Breakpoint already set")
+            if condition:
+                self._set_breakpoint_condition(fn, line, condition)
+                print("Condition updated")
+            return
+        if condition:
+            # first, as it fails for invalid conditions
+            self._set_breakpoint_condition(fn, line, condition)
+        self._breakpoints_in_files[fn].add(line)
+        self._update_break_keys()
+        if fn not in self._scopes_with_breakpoint:
+            self._scopes_with_breakpoint[fn] = {}
+        if scope_start_line not in self._scopes_with_breakpoint[fn]:
+            self._scopes_with_breakpoint[fn][scope_start_line] = 0
+        self._scopes_with_breakpoint[fn][scope_start_line] += 1
+        if fn not in self._breakpoint_to_scope_start:
+            self._breakpoint_to_scope_start[fn] = {}
+        self._breakpoint_to_scope_start[fn][line] = scope_start_line
+        print("Breakpoint set")
+
+    def remove_breakpoint(self, file: Path, line: int, scope_start_line: int):
+        fn = str(file)
+        if fn in self._breakpoints_in_files:
+            self._breakpoints_in_files[fn].remove(line)
+            self._update_break_keys()
+            if scope_start_line in self._scopes_with_breakpoint[fn]:
+                self._scopes_with_breakpoint[fn][scope_start_line] -= 1
+                if self._scopes_with_breakpoint[fn][scope_start_line] == 0:
+                    del self._scopes_with_breakpoint[fn][scope_start_line]
+            del self._breakpoint_to_scope_start[fn][line]
+            self._remove_breakpoint_condition(fn, line)
+            print("Breakpoint removed")
+
+    def _bulk_remove(self, fn: str):
+        """ remove all breakpoints in the file at once, without updating the scope counts one by one """
+        lines = self._breakpoints_in_files.pop(fn, set())
+        self._scopes_with_breakpoint.pop(fn, None)
+        self._breakpoint_to_scope_start.pop(fn, None)
+        for line in lines:
+            self._remove_breakpoint_condition(fn, line)
+            print("Breakpoint removed")
+
+    def remove_all_breakpoints(self, file: Optional[Path] = None):
+        for fn in ([str(file)] if file else list(self._breakpoints_in_files)):
+            self._bulk_remove(fn)
+        self._update_break_keys()
+
+    def _update_break_keys(self):
+        self._break_keys = frozenset((fn, line) for fn, lines in self._breakpoints_in_files.items()
+                                     for line in lines)
+        self._update_interesting_prefixes()
+        self._update_armed()
+        self._restart_monitoring()
+
+    def _update_interesting_prefixes(self):
+        files = [fn for fn, lines in self._breakpoints_in_files.items() if lines]
+        if self._main_file_str:
+            files.append(self._main_file_str)
+        prefixes = set()
+        for f in files:
+            # the file name itself, as the main file is compiled with a relative name,
+            # and the directory for all other modules
+            prefixes.add(f)
+            prefixes.add(os.path.dirname(os.path.abspath(f)) + os.sep)
+        self._interesting_prefixes = tuple(prefixes)
+
+    def _update_armed(self):
+        self._armed = bool(self._break_keys) or bool(self._single_step) or \
+            self._single_step_instead_of_continue or self._is_first_call
+
+    def _ensure_rich_formatter(self):
+        """ import bpython and pygments, if available, and use them for the shell and the code formatting """
+        if self._initialized:
+            return
+        self._initialized = True
         try:
             import bpython
             self.bpython = bpython
@@ -104,113 +376,93 @@ class Dbg:
                         outfile.write('\n')
                     outfile.write(self.line_prefix(self._lineno))
 
+            # the lexer has no state between calls, so create it (and its options) only once
+            lexer = Python3Lexer()
             self.code_formatter = lambda code, line_prefix: pygformat(
-                Python3Lexer().get_tokens(code), CustomTerminalFormatter(line_prefix)
+                lexer.get_tokens(code), CustomTerminalFormatter(line_prefix)
             )
         except ImportError:
             pass
-        # file -> {line numbers of break points}
-        self._breakpoints_in_files: Dict[Path, Set[int]] = {}
-        self._breakpoint_conditions: Dict[Tuple[Path, int], str] = {}
-        # file -> {starting numbers of scopes with breakpoints mapped to the breakpoint count}
-        self._scopes_with_breakpoint: Dict[Path, Dict[int, int]] = {}
-        # file -> {line number of breakpoint -> starting line number of scope}
-        self._breakpoint_to_scope_start: Dict[Path, Dict[int, int]] = {}
-        self._is_first_call = True
-        self._single_step: Optional[StepState] = None
-        """ if true, step into functions when single stepping """
-        self._single_step_instead_of_continue = False
-        self._single_step_instead_of_continue_into = False
-        self._single_step_instead_of_continue_out = False
-
-    def add_breakpoint(self, file: Path, line: int, scope_start_line: int, condition: Optional[str] = None):
-        if file not in self._breakpoints_in_files:
-            self._breakpoints_in_files[file] = set()
-        if line in self._breakpoints_in_files[file]:
-            print("Breakpoint already set")
-            if condition:
-                self._breakpoint_conditions[(file, line)] = condition
-                print("Condition updated")
-            return
-        self._breakpoints_in_files[file].add(line)
-        if file not in self._scopes_with_breakpoint:
-            self._scopes_with_breakpoint[file] = {}
-        if scope_start_line not in self._scopes_with_breakpoint[file]:
-            self._scopes_with_breakpoint[file][scope_start_line] = 0
-        self._scopes_with_breakpoint[file][scope_start_line] += 1
-        if file not in self._breakpoint_to_scope_start:
-            self._breakpoint_to_scope_start[file] = {}
-        self._breakpoint_to_scope_start[file][line] = scope_start_line
-        if condition:
-            self._breakpoint_conditions[(file, line)] = condition
-        print("Breakpoint set")
-
-    def remove_breakpoint(self, file: Path, line: int, scope_start_line: int):
-        if file in self._breakpoints_in_files:
-            self._breakpoints_in_files[file].remove(line)
-            if scope_start_line in self._scopes_with_breakpoint[file]:
-                self._scopes_with_breakpoint[file][scope_start_line] -= 1
-                if self._scopes_with_breakpoint[file][scope_start_line] == 0:
-                    del self._scopes_with_breakpoint[file][scope_start_line]
-            del self._breakpoint_to_scope_start[file][line]
-            del self._breakpoint_conditions[(file, line)]
-            print("Breakpoint removed")
-
-    def _get_breakpoint_condition(self, file: Path, line: int) -> Optional[str]:
-        if (file, line) in self._breakpoint_conditions:
-            return self._breakpoint_conditions[(file, line)]
+        self._format_code.cache_clear()
 
     def get_breakpoints(self, file: Path) -> Dict[int, Optional[str]]:
-        if file not in self._breakpoints_in_files:
+        fn = str(file)
+        if fn not in self._breakpoints_in_files:
             return {}
-        return {b: self._get_breakpoint_condition(file, b) for b in self._breakpoints_in_files[file]}
+        return {b: self._breakpoint_condition_sources.get((fn, b)) for b in self._breakpoints_in_files[fn]}
 
     """
     Print code on the command line
 
     :param code: the code to print
+    :param lines: the already split lines of the code to print, used instead of code
     :param current_line: the current line that should be highlighted, -1 to not highlight anything
     :param breakpoints: breakpoints to highlight
     :param header: header to print before the code
     """
 
     def print_code(self, *,
-                   code: str,
+                   code: Optional[str] = None,
+                   lines: Optional[Sequence[str]] = None,
                    current_line: int = -1,
                    breakpoints: Optional[Dict[int, Optional[str]]] = None,
                    header: Optional[str] = None,
                    start_line: int = 1,
                    end_line: int = -1,
                    code_start_line: int = 1):
-        lines = code.splitlines()
+        if lines is None:
+            lines = code.splitlines()
         end_line = len(lines) if end_line == -1 else end_line - code_start_line
-        subset = lines[start_line - code_start_line:end_line]
+        # empty lines are replaced by a space, so that the formatter does not drop them
+        subset = [line or " " for line in lines[start_line - code_start_line:end_line]]
         max_line_number_digits = min(len(str(max(end_line, code_start_line + len(subset)))), 4)
-        has_prefix = current_line >= 0 or breakpoints
-
-        def format_line_number(relative_line_number: int):
-            if relative_line_number > len(subset):
-                return ""
-            line_number = relative_line_number + start_line - 1
-            line_number_part = f"{line_number:>{max_line_number_digits}} "
-            prefix = ""
-            suffix = ""
-            if has_prefix:
-                prefix = (">" if current_line == line_number else " ") + " "
-                if breakpoints and line_number in breakpoints:
-                    suffix = "*"
-                    if breakpoints[line_number] is not None:
-                        suffix += " " + breakpoints[line_number]
-            return prefix + line_number_part + suffix
+        has_prefix = bool(current_line >= 0 or breakpoints)
 
         if header:
             print(header)
-        for i in range(len(subset)):
-            if subset[i] == "":
-                subset[i] = " "
-        print(self.code_formatter("\n".join(subset), format_line_number))
+        print(self._format_code("\n".join(subset), len(subset), start_line, max_line_number_digits,
+                                has_prefix, current_line,
+                                tuple(sorted(breakpoints.items())) if breakpoints else ()))
+
+    def _format_code_uncached(self, code: str, line_count: int, start_line: int, max_line_number_digits: int,
+                              has_prefix: bool, current_line: int,
+                              breakpoint_items: Tuple[Tuple[int, Optional[str]], ...]) -> str:
+        # the formatter is called for every line, so precompute everything possible
+        # and use a specialized function for each case
+        fmt = f"{{:>{max_line_number_digits}}} ".format
+        offset = start_line - 1
+        # line number -> breakpoint marker
+        markers = {line: "*" if condition is None else "* " + condition for line, condition in breakpoint_items}
+
+        def format_plain(relative_line_number: int):
+            if relative_line_number > line_count:
+                return ""
+            return fmt(relative_line_number + offset)
+
+        def format_current(relative_line_number: int):
+            if relative_line_number > line_count:
+                return ""
+            line_number = relative_line_number + offset
+            return ("> " if current_line == line_number else "  ") + fmt(line_number)
+
+        def format_current_and_breakpoints(relative_line_number: int):
+            if relative_line_number > line_count:
+                return ""
+            line_number = relative_line_number + offset
+            return ("> " if current_line == line_number else "  ") + fmt(line_number) + markers.get(line_number, "")
+
+        if not has_prefix:
+            format_line_number = format_plain
+        elif markers:
+            format_line_number = format_current_and_breakpoints
+        else:
+            format_line_number = format_current
+        return self.code_formatter(code, format_line_number)
 
     def _fancy_eval(self, _locals: dict, message: str):
+        if isinstance(_locals, ShellNamespace):
+            # bpython iterates over the locals for its auto completion
+            _locals = _locals.materialize()
         ret = self.bpython.embed(locals_=_locals, banner=message)
         if isinstance(ret, DbgContinue):
             if ret.exit:
@@ -238,14 +490,62 @@ class Dbg:
 
     def _breakpoint(self, frame: types.FrameType = None, show_context: bool = True,
                     reason: str = "breakpoint", *args, **kwargs):
-        if self._in_breakpoint or self._skip_count < 0:
+        # checked before any work with the frame, skipped breakpoints return right away
+        if self._in_breakpoint:
             return
-        if self._skip_count > 0:
-            self._skip_count -= 1
+        skip_count = self._skip_count
+        if skip_count:
+            # negative counts skip all breakpoints
+            if skip_count > 0:
+                self._skip_count = skip_count - 1
             return
         frame = frame or sys._getframe(1)
+        self._ensure_rich_formatter()
+
+        # the helpers are created once and use the frame of the current breakpoint
+        self._current_frame = frame
+        helpers = self._helpers
+        helpers["_frame"] = frame
 
+        self._in_breakpoint = True
+        message = f"{reason} at {self._location(frame)}"
+        if show_context:
+            helpers["context"]()
+        self._eval(_locals=ShellNamespace(frame.f_locals, helpers, frame.f_globals), message=message)
+
+        if self._single_step_instead_of_continue:
+            self._step_setup(frame, self._single_step_instead_of_continue_into,
+                             self._single_step_instead_of_continue_out)
+
+        # frames on the stack might have been entered before their breakpoints were set
+        f = frame
+        while f:
+            if self._has_break_point_in(f.f_code):
+                self._trace_frame(f)
+            f = f.f_back
+
+        self._current_frame = None
+        helpers["_frame"] = None
+        self._in_breakpoint = False
+
+    @staticmethod
+    def _location(frame: types.FrameType) -> str:
+        return f"{frame.f_code.co_filename}:{frame.f_lineno} ({frame.f_code.co_name})"
+
+    def _step_setup(self, frame: types.FrameType, into=False, out=False):
+        assert not (into and out)
+        self._single_step = StepState(into and StepMode.into or out
+                                      and StepMode.out or StepMode.over, frame, frame.f_lineno)
+        self._update_armed()
+        # lines that were disabled might be single stepped now
+        self._restart_monitoring()
+        # the frame might not be traced yet (e.g. when called via breakpoint())
+        self._trace_frame(frame)
+
+    def _create_helpers(self) -> Dict[str, object]:
+        """ create the helpers of the shell, they use the frame of the current breakpoint """
         helpers = {}
+        help_texts: Dict[Tuple[str, ...], str] = {}
 
         def func(f: Callable) -> Callable:
             helpers[f.__name__.lstrip('_')] = f
@@ -270,14 +570,12 @@ class Dbg:
         @func
         def _locals():
             """show local variables"""
-            return frame.f_locals
-
-        location = f"{frame.f_code.co_filename}:{frame.f_lineno} ({frame.f_code.co_name})"
+            return self._current_frame.f_locals
 
         @func
         def _location():
             """show current location"""
-            return location
+            return self._location(self._current_frame)
 
         @func
         def show(file=None, start=1, end=-1, header=None):
@@ -285,9 +583,10 @@ class Dbg:
             show code, file (default:None, current file),
             start (default:1), end (default:-1)
             """
-            code = Path(file or frame.f_code.co_filename).read_text()
-            self.print_code(code=code,
-                            breakpoints=self.get_breakpoints(Path(file or frame.f_code.co_filename)),
+            frame = self._current_frame
+            path = Path(file or frame.f_code.co_filename)
+            self.print_code(lines=read_source(path),
+                            breakpoints=self.get_breakpoints(path),
                             current_line=frame.f_lineno,
                             start_line=max(1, start),
                             end_line=end)
@@ -298,7 +597,8 @@ class Dbg:
             show context of current location,
             pre (default:4) lines before, post (default:4) lines after
             """
-            show(start=frame.f_lineno - pre, end=frame.f_lineno + post)
+            line = self._current_frame.f_lineno
+            show(start=line - pre, end=line + post)
 
         @func
         def current_file():
@@ -306,9 +606,22 @@ class Dbg:
             show()
 
         @func
-        def stacktrace():
-            """show stacktrace"""
-            print("".join(traceback.format_stack(frame)))
+        def stacktrace(source: bool = True):
+            """show stacktrace, source (default:True) to show the source lines"""
+            # walk the frames directly, like traceback.format_stack but without
+            # extracting a StackSummary and checking the line cache of every file
+            entries = []
+            f = self._current_frame
+            while f:
+                co = f.f_code
+                entry = f'  File "{co.co_filename}", line {f.f_lineno}, in {co.co_name}\n'
+                if source:
+                    line = linecache.getline(co.co_filename, f.f_lineno, f.f_globals).strip()
+                    if line:
+                        entry += f"    {line}\n"
+                entries.append(entry)
+                f = f.f_back
+            print("".join(reversed(entries)))
 
         @func
         def show_function(func: Callable = None):
@@ -316,17 +629,21 @@ class Dbg:
             show code of function, func (default:None) current function
             """
             if func is None:
-                co = frame.f_code
+                co = self._current_frame.f_code
                 file = None
             else:
                 co = func.__code__
-                file = inspect.getsourcefile(func)
-            show(file, start=co.co_firstlineno, end=co.co_firstlineno + len(inspect.getsource(co).splitlines()) - 1)
+                file = _source_file(co)
+            # the end line of show is exclusive
+            show(file, start=co.co_firstlineno, end=_last_line(co) + 1)
 
         @func
         def break_at_func(func: Callable = None, line: int = -1, condition: Optional[str] = None):
             """break at function (optional line number, optional condition string)"""
-            self.add_breakpoint(Path(inspect.getsourcefile(func)), line, func.__code__.co_firstlineno, condition)
+            # co_filename is the name that the trace function sees
+            co = func.__code__
+            self.add_breakpoint(Path(co.co_filename), co.co_firstlineno + 1 if line == -1 else line,
+                                co.co_firstlineno, condition)
 
         @func
         def break_at_line(file: str, func: str, line: int = -1, condition: Optional[str] = None):
@@ -340,7 +657,8 @@ class Dbg:
         @func
         def remove_break(func: Callable, line: int):
             """remove breakpoint in function object"""
-            self.remove_breakpoint(Path(inspect.getsourcefile(func)), line, func.__code__.co_firstlineno)
+            co = func.__code__
+            self.remove_breakpoint(Path(co.co_filename), line, co.co_firstlineno)
 
         @func
         def remove_break_at_line(file: str, func: str, line: int):
@@ -352,17 +670,7 @@ class Dbg:
         @func
         def remove_all_breaks(file: Optional[str] = None):
             """remove all breakpoints, in the file or all files if file is None"""
-            if file:
-                for line, condition in list(self.get_breakpoints(Path(file)).items()):
-                    self.remove_breakpoint(Path(file), line, self._breakpoint_to_scope_start[Path(file)][line])
-            else:
-                for file in self._breakpoints_in_files.keys():
-                    remove_all_breaks(str(file))
-
-        def _step_setup(into=False, out=False):
-            assert not (into and out)
-            self._single_step = StepState(into and StepMode.into or out
-                                          and StepMode.out or StepMode.over, frame)
+            self.remove_all_breakpoints(Path(file) if file else None)
 
         @func
         def step(into=False, out=False):
@@ -371,7 +679,7 @@ class Dbg:
             out (default:False) to step out of calls only
             """
             self._single_step_instead_of_continue = False
-            _step_setup(into, out)
+            self._step_setup(self._current_frame, into, out)
             raise SystemExit(DbgContinue(exit=False))
 
         @func
@@ -395,61 +703,99 @@ class Dbg:
             self._single_step_instead_of_continue = enable
             self._single_step_instead_of_continue_into = into
             self._single_step_instead_of_continue_out = out
+            self._update_armed()
 
         @func
         def dbg_help():
             """show this help"""
-            parts = {"_h": "dict with all helper functions",
-                     "_st": "store dict, shared between shells",
-                     "_frame": "current frame",
-                     "_dbg": "debugger"}
-            for k, v in helpers.items():
-                if not isinstance(v, Callable):
-                    continue
-                name = "{:<20}".format(f"{k}({','.join(inspect.signature(v).parameters.keys())})")
-                parts[name] = inspect.getdoc(v)
-            longest = max(len(k) for k in parts.keys())
-            print("  Ctrl-D to continue")
-            for k, v in parts.items():
-                prefix = f"  {k:<{longest}}   "
-                p = '\n' + ' ' * len(prefix)
-                print(f"{prefix}{p.join(v.splitlines())}")
+            # the helpers only change when they are modified via _h,
+            # so the help text is only created again in this case
+            keys = tuple(helpers)
+            if keys not in help_texts:
+                help_texts.clear()
+                help_texts[keys] = self._help_text(helpers)
+            print(help_texts[keys])
 
         helpers["_st"] = self._st
-        helpers["_frame"] = frame
+        helpers["_frame"] = None
         helpers["_h"] = helpers
         helpers["_dbg"] = self
+        return helpers
+
+    @staticmethod
+    def _help_text(helpers: Dict[str, object]) -> str:
+        parts = {"_h": "dict with all helper functions",
+                 "_st": "store, shared between shells, _st.name or _st['name']",
+                 "_frame": "current frame",
+                 "_dbg": "debugger"}
+        for k, v in helpers.items():
+            if not isinstance(v, Callable):
+                continue
+            name = "{:<20}".format(f"{k}({','.join(inspect.signature(v).parameters.keys())})")
+            parts[name] = inspect.getdoc(v) or ""
+        longest = max(len(k) for k in parts.keys())
+        lines = ["  Ctrl-D to continue"]
+        for k, v in parts.items():
+            prefix = f"  {k:<{longest}}   "
+            p = '\n' + ' ' * len(prefix)
+            lines.append(f"{prefix}{p.join(v.splitlines())}")
+        return "\n".join(lines)
+
+    def _trace_frame(self, frame: types.FrameType):
+        """ make sure that the line and return events of the frame are handled """
+        if self._use_monitoring:
+            events = mon.events.LINE | mon.events.PY_RETURN
+            # setting the events re-instruments the code, avoid it for every call of the same code
+            if mon.get_local_events(mon.DEBUGGER_ID, frame.f_code) != events:
+                mon.set_local_events(mon.DEBUGGER_ID, frame.f_code, events)
+        else:
+            frame.f_trace = self._dispatch_trace
 
-        self._in_breakpoint = True
-        message = f"{reason} at {location}"
-        if show_context:
-            context()
-        self._eval(_locals=frame.f_locals | helpers | frame.f_globals, message=message)
-
-        if self._single_step_instead_of_continue:
-            _step_setup(self._single_step_instead_of_continue_into, self._single_step_instead_of_continue_out)
-
-        self._in_breakpoint = False
+    def _restart_monitoring(self):
+        """ re-enable the line events that the line callback disabled """
+        if self._use_monitoring:
+            mon.restart_events()
 
     def _has_break_point_in(self, code: types.CodeType) -> bool:
-        return Path(code.co_filename) in self._breakpoints_in_files and \
-            code.co_firstlineno in self._scopes_with_breakpoint[Path(code.co_filename)]
-
-    def _should_break_at(self, frame: types.FrameType) -> bool:
-        p = Path(frame.f_code.co_filename)
-        if p in self._breakpoints_in_files and frame.f_lineno in self._breakpoints_in_files[p]:
-            if (p, frame.f_lineno) in self._breakpoint_conditions:
-                return eval(self._breakpoint_conditions[(p, frame.f_lineno)], frame.f_globals, frame.f_locals)
-            return True
-        return False
+        scopes = self._scopes_with_breakpoint.get(code.co_filename)
+        return scopes is not None and code.co_firstlineno in scopes
 
-    def _handle_line(self, frame: types.FrameType):
-        if self._should_break_at(frame):
+    def _should_break_at(self, frame: types.FrameType, code: types.CodeType, line: int) -> bool:
+        key = (code.co_filename, line)
+        if key not in self._break_keys:
+            return False
+        cond = self._breakpoint_conditions.get(key)
+        if cond is None:
+            return True
+        names = self._breakpoint_condition_names[key]
+        # only functions have fast locals that the condition could not see otherwise,
+        # and only if they do not access their locals by name
+        if names is not None and code.co_flags & inspect.CO_OPTIMIZED and \
+                _locals_accessors.isdisjoint(code.co_names) and names.isdisjoint(code.co_varnames) and \
+                names.isdisjoint(code.co_cellvars) and names.isdisjoint(code.co_freevars):
+            # accessing f_locals copies all locals of the frame, so skip it
+            # if the condition does not use any of them
+            return eval(cond, frame.f_globals, {})
+        return eval(cond, frame.f_globals, frame.f_locals)
+
+    def _handle_line(self, frame: types.FrameType, code: types.CodeType, line: int):
+        if self._should_break_at(frame, code, line):
             self._breakpoint(frame, reason="breakpoint")
 
     def _default_dispatch(self, frame: types.FrameType, event, arg):
+        # only trace the lines of frames that might stop,
+        # returning None disables the local tracing for all other frames
         if event == 'call':
-            return self._dispatch_trace
+            code = frame.f_code
+            fn = code.co_filename
+            if self._has_break_point_in(code) or (self._is_first_call and fn == self._main_file_str):
+                return self._dispatch_trace
+            # the stepped frame is already traced, only stepping into enters new frames,
+            # but not frames of libraries outside the directories of the debugged files
+            step = self._single_step
+            if step and step.mode == StepMode.into and fn.startswith(self._interesting_prefixes):
+                return self._dispatch_trace
+            return None
 
     def _should_single_step(self, frame: types.FrameType, event) -> bool:
         if not self._single_step:
@@ -462,41 +808,122 @@ class Dbg:
             return frame == self._single_step.frame
         return False
 
-    def _dispatch_trace(self, frame: types.FrameType, event, arg):
-        if event == 'return' and frame.f_code.co_name == '<module>' and \
-                frame.f_back and frame.f_back.f_code.co_filename == __file__:
-            return
-        if self._is_first_call and self._main_file == Path(frame.f_code.co_filename):
+    def _break_at_start(self, frame: types.FrameType) -> bool:
+        """
+        stop at the first event in the main file, returns true if it stopped,
+        callers check _is_first_call first, to save the call afterwards
+        """
+        if frame.f_code.co_filename == self._main_file_str:
             self._is_first_call = False
+            self._update_armed()
             self._breakpoint(frame, show_context=False, reason="start")
-            return self._default_dispatch(frame, event, arg)
-        if self._should_single_step(frame, event):
-            if event == 'return':
-                if frame.f_back:
-                    self._single_step.frame = frame.f_back
-                    self._breakpoint(frame.f_back, reason="step")
-                return
-            if self._single_step.mode == StepMode.out:
-                return
-            if event == 'line':
-                self._single_step = None
-                self._breakpoint(frame, reason="step")
+            return True
+        return False
+
+    def _trace_call(self, frame: types.FrameType):
+        if self._is_first_call:
+            self._break_at_start(frame)
+        return self._default_dispatch(frame, 'call', None)
+
+    def _trace_line(self, frame: types.FrameType, code: types.CodeType, line: int):
+        if not self._armed:
+            # nothing is left to stop at (all breakpoints were removed), so stop tracing
+            # the lines of this frame, breakpoints and stepping trace it again if needed
+            frame.f_trace = None
+            return
+        if self._is_first_call and self._break_at_start(frame):
+            return
+        step = self._single_step
+        if step and (step.mode == StepMode.into or (step.mode == StepMode.over and frame == step.frame)):
+            if line == step.line and step.mode == StepMode.over:
+                # the loop jumped back to the same line, only stop once it is left
+                step.skipped += 1
                 return
+            self._single_step = None
+            self._update_armed()
+            reason = f"step (skipped {step.skipped} repetitions of line {step.line})" if step.skipped else "step"
+            self._breakpoint(frame, reason=reason)
+            return
+        # most lines of traced frames have no breakpoint, so check this before calling the handler
+        if (code.co_filename, line) in self._break_keys:
+            self._handle_line(frame, code, line)
+
+    def _trace_return(self, frame: types.FrameType):
+        if not self._armed:
+            return
+        back = frame.f_back
+        if back and frame.f_code.co_name == '<module>' and back.f_code.co_filename == __file__:
+            return
+        if self._is_first_call and self._break_at_start(frame):
+            return
+        if self._should_single_step(frame, 'return') and frame.f_back:
+            self._single_step.frame = frame.f_back
+            self._single_step.line = -1
+            # the caller is not necessarily traced
+            self._trace_frame(frame.f_back)
+            self._breakpoint(frame.f_back, reason="step")
+
+    def _dispatch_trace(self, frame: types.FrameType, event, arg):
+        # each event has its own handler, so that the common line event
+        # does not go through the checks for the other events
+        if event == 'line':
+            return self._trace_line(frame, frame.f_code, frame.f_lineno)
         if event == 'call':
-            if self._has_break_point_in(frame.f_code):
-                return self._dispatch_trace
-            else:
-                return self._default_dispatch(frame, event, arg)
-        elif event == 'line':
-            self._handle_line(frame)
+            return self._trace_call(frame)
+        if event == 'return':
+            return self._trace_return(frame)
+
+    # sys.monitoring callbacks, they pass the events on to the trace dispatcher
 
-    def run(self, file: Path):
+    def _monitor_start(self, code: types.CodeType, instruction_offset: int):
+        if self._in_breakpoint:
+            return
+        frame = sys._getframe(1)
+        if self._default_dispatch(frame, 'call', None) is None:
+            # the interpreter does not report the start of this code again,
+            # until the breakpoints or the stepping change
+            return mon.DISABLE
+        # only code with breakpoints (or when stepping) gets line events
+        self._trace_frame(frame)
+
+    def _monitor_line(self, code: types.CodeType, line_number: int):
+        if not self._single_step and not self._is_first_call and \
+                (code.co_filename, line_number) not in self._break_keys:
+            # the interpreter skips this line from now on, without calling back into Python,
+            # until the breakpoints or the stepping change
+            return mon.DISABLE
+        self._trace_line(sys._getframe(1), code, line_number)
+
+    def _monitor_return(self, code: types.CodeType, instruction_offset: int, retval: object):
+        self._trace_return(sys._getframe(1))
+        if not self._single_step and not self._has_break_point_in(code):
+            # stepping might have enabled the local events
+            mon.set_local_events(mon.DEBUGGER_ID, code, 0)
+
+    def _setup_monitoring(self, compiled: types.CodeType):
+        tool_id = mon.DEBUGGER_ID
+        mon.use_tool_id(tool_id, "dbg")
+        mon.register_callback(tool_id, mon.events.PY_START, self._monitor_start)
+        mon.register_callback(tool_id, mon.events.LINE, self._monitor_line)
+        mon.register_callback(tool_id, mon.events.PY_RETURN, self._monitor_return)
+        mon.set_events(tool_id, mon.events.PY_START)
+        # the main code object is started via exec, so enable its line events directly
+        mon.set_local_events(tool_id, compiled, mon.events.LINE | mon.events.PY_RETURN)
+
+    def run(self, file: Path, optimize: int = -1):
         self._main_file = file
+        self._main_file_str = str(file)
+        self._update_interesting_prefixes()
         # see https://realpython.com/python-exec/#using-python-for-configuration-files
-        compiled = compile(file.read_text(), filename=file.name, mode='exec')
+        # shares the cached text with the show helpers
+        source = read_text(file)
+        compiled = compile(source, filename=file.name, mode='exec', optimize=optimize)
         sys.argv.pop(0)
         sys.breakpointhook = self._breakpoint
-        sys.settrace(self._dispatch_trace)
+        if self._use_monitoring:
+            self._setup_monitoring(compiled)
+        else:
+            sys.settrace(self._dispatch_trace)
         exec(compiled, _globals)
 
 
@@ -504,12 +931,16 @@ if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
     argparser.add_argument("file", help="file to debug")
     argparser.add_argument("args", nargs="*", help="arguments to pass to file")
+    argparser.add_argument("--optimize", type=int, choices=[0, 1, 2], default=-1,
+                           help="optimization level of the file, 2 removes asserts and docstrings")
     args = argparser.parse_args()
+    # the file should only see its own arguments
+    sys.argv = [sys.argv[0], args.file, *args.args]
     dbg = Dbg()
     print("Tiny debugger https://github.com/parttimenerd/python-dbg/")
-    if not dbg.bpython:
+    if find_spec("bpython") is None:
         print("Install bpython for a better debugging experience")
     try:
-        dbg.run(Path(args.file))
+        dbg.run(Path(args.file), optimize=args.optimize)
     except KeyboardInterrupt:
         pass
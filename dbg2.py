@@ -1,30 +1,135 @@
 #!/usr/bin/env python3
 import argparse
+import bisect
+import codeop
 import inspect
-import re
+import linecache
+import os
 import sys
+import sysconfig
 import tokenize
-import traceback
 import types
+import weakref
 from code import InteractiveConsole
+from collections import ChainMap
 from dataclasses import dataclass, field
 from enum import Enum
+from functools import lru_cache
 from pathlib import Path
-from typing import Callable, Optional, Dict, Set, Union
+from typing import Callable, Optional, Dict, Set, Union, List, Tuple, \
+    NamedTuple
 
 _globals = globals().copy()
 
 
-@dataclass(frozen=True)
-class CodeId:
-    """ Identifier of a code object (like a function) """
+@lru_cache(maxsize=32)
+def _read_text(path: str, mtime: int) -> str:
+    """
+    Text of the file, the modification time is part of the key,
+    so that changed files are read again
+    """
+    return Path(path).read_text()
+
+
+@lru_cache(maxsize=64)
+def _def_index(path: str, mtime: int) -> Dict[str, List[int]]:
+    """
+    Function name -> sorted line numbers of its definitions in the file,
+    the modification time is part of the key, so that changed files are read again
+
+    Uses the code objects of the compiled file, so definitions in strings
+    and comments are ignored and indented definitions (like methods) are
+    found too. Falls back to the tokens for files with syntax errors.
+    """
+    with open(path, 'rb') as fp:
+        source = fp.read()
+    try:
+        compiled = compile(source, path, 'exec', dont_inherit=True)
+    except (SyntaxError, ValueError):
+        return _def_index_from_tokens(path)
+    index: Dict[str, List[int]] = {}
+    for code in _walk_code(compiled):
+        # only functions, not classes and modules
+        if code.co_flags & inspect.CO_OPTIMIZED:
+            index.setdefault(code.co_name, []).append(code.co_firstlineno)
+    for lines in index.values():
+        lines.sort()
+    return index
+
+
+def _def_index_from_tokens(path: str) -> Dict[str, List[int]]:
+    """ _def_index based on the tokens of the file, up to the first error """
+    index: Dict[str, List[int]] = {}
+    with open(path, 'rb') as fp:
+        prev: Optional[tokenize.TokenInfo] = None
+        # the code objects of decorated functions start at the first decorator
+        decorator_line: Optional[int] = None
+        try:
+            for tok in tokenize.tokenize(fp.readline):
+                if tok.type == tokenize.OP and tok.string == '@' and decorator_line is None and \
+                        (prev is None or prev.type in (tokenize.NEWLINE, tokenize.NL,
+                                                       tokenize.INDENT, tokenize.DEDENT)):
+                    decorator_line = tok.start[0]
+                elif tok.type == tokenize.NAME and prev is not None and \
+                        prev.type == tokenize.NAME and prev.string in ('def', 'class'):
+                    if prev.string == 'def':
+                        # token lines start at 1, like the consumers of this info expect
+                        index.setdefault(tok.string, []).append(decorator_line or tok.start[0])
+                    decorator_line = None
+                prev = tok
+        except (tokenize.TokenError, SyntaxError):
+            # keep the definitions found before the error
+            pass
+    return index
+
+
+@lru_cache(maxsize=256)
+def _last_line(code: types.CodeType) -> int:
+    """ Last line of a code object, based on its line table and not its source """
+    if hasattr(code, "co_lines"):
+        last = max((line for _, _, line in code.co_lines()
+                    if line is not None), default=code.co_firstlineno)
+    else:
+        # python < 3.10: co_lnotab contains pairs of byte and line
+        # increments, the latter are signed
+        last = line = code.co_firstlineno
+        for increment in code.co_lnotab[1::2]:
+            line += increment - 0x100 if increment >= 0x80 else increment
+            last = max(last, line)
+    # nested functions and classes have their own line tables
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            last = max(last, _last_line(const))
+    return last
+
+
+def _walk_code(code: types.CodeType):
+    """ Yield the code object and all code objects nested in it """
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from _walk_code(const)
+
+
+_interned_paths: Dict[str, Path] = {}
+""" absolute path string -> path, so that code ids share their (hashed) paths """
+
+
+class CodeId(NamedTuple):
+    """
+    Identifier of a code object (like a function),
+    create it with make to get an absolute path
+    """
     path: Path
     """ File that the code object lives in, has to be an absolute path """
     start_line: int
     """ Line number of the first line of the code object """
 
-    def __post_init__(self):
-        assert self.path.is_absolute()
+    @staticmethod
+    def make(path: Path, start_line: int) -> 'CodeId':
+        if not path.is_absolute():
+            path = path.absolute()
+        return CodeId(_interned_paths.setdefault(str(path), path), start_line)
 
 
 @dataclass(frozen=True)
@@ -34,21 +139,45 @@ class Breakpoint:
     line: int
     condition: Optional[str] = None
     """ Optional conditional expression """
+    _compiled: Optional[types.CodeType] = field(default=None, init=False,
+                                                repr=False, compare=False)
+    """ Compiled condition, so that it is not compiled on every hit """
+
+    def __post_init__(self):
+        if self.condition is not None:
+            # fails early for invalid conditions
+            object.__setattr__(self, '_compiled',
+                               compile(self.condition, f"<condition of line {self.line}>", 'eval'))
 
     def test(self, _globals: dict, _locals: dict) -> bool:
         """ Test if the execution should stop at a breakpoint """
-        return self.condition is None or eval(self.condition, _globals, _locals)
+        return self._compiled is None or eval(self._compiled, _globals, _locals)
+
+    def test_frame(self, frame: types.FrameType) -> bool:
+        """
+        Test if the execution should stop at a breakpoint in the frame,
+        only creates the locals of the frame if there is a condition
+        """
+        return self._compiled is None or \
+            eval(self._compiled, frame.f_globals, frame.f_locals)
 
 
 @dataclass
 class CodeInfo:
     """ Information about a code object """
 
+    # written by hand, dataclass(slots=True) requires python 3.10,
+    # so the fields can't have defaults
+    __slots__ = ("id", "code", "breakpoint_lines")
+
     id: CodeId
-    code: Optional[types.CodeType] = None
+    code: Optional[types.CodeType]
     """ Code object """
-    breakpoints: Set[Breakpoint] = field(default_factory=set)
-    """ Breakpoints in the code object """
+    breakpoint_lines: Optional[Set[int]]
+    """
+    Lines of the breakpoints in the code object, None before the first is added,
+    the breakpoints themselves are stored in the DbgFile
+    """
 
 
 class DbgFile:
@@ -63,22 +192,42 @@ class DbgFile:
 
     def __getitem__(self, code_id: CodeId) -> CodeInfo:
         if code_id not in self._codes:
-            self._codes[code_id] = CodeInfo(code_id)
+            self._codes[code_id] = CodeInfo(code_id, None, None)
         return self._codes[code_id]
 
     def add_breakpoint(self, breakpoint: Breakpoint):
         self.breakpoints[breakpoint.line] = breakpoint
         code_info = self[breakpoint.code]
-        code_info.breakpoints.add(breakpoint)
+        if code_info.breakpoint_lines is None:
+            code_info.breakpoint_lines = set()
+        code_info.breakpoint_lines.add(breakpoint.line)
 
     def set_code_object(self, code_id: CodeId, code: types.CodeType):
         self[code_id].code = code
 
-    def remove_breakpoint(self, breakpoint: Breakpoint):
-        self.breakpoints.pop(breakpoint.line)
-        self[breakpoint.code].breakpoints.remove(breakpoint)
-        if len(self[breakpoint.code].breakpoints) == 0:
-            self._codes.pop(breakpoint.code)
+    def remove_breakpoint(self, breakpoint: Breakpoint) -> Breakpoint:
+        """ Remove the breakpoint at the line of the passed breakpoint, returns the removed breakpoint """
+        # the stored breakpoint might have a condition
+        breakpoint = self.breakpoints.pop(breakpoint.line)
+        code_lines = self._codes[breakpoint.code].breakpoint_lines
+        code_lines.discard(breakpoint.line)
+        if not code_lines:
+            del self._codes[breakpoint.code]
+        return breakpoint
+
+    def has_breakpoints_in_code(self, code_id: CodeId) -> bool:
+        return code_id in self._codes
+
+    def get_code_info(self, code_id: CodeId) -> Optional[CodeInfo]:
+        """ Get the code info, if the code object has breakpoints """
+        return self._codes.get(code_id)
+
+    def get_code_breakpoints(self, code_id: CodeId) -> Dict[int, Breakpoint]:
+        """ Get the breakpoints in a code object (line number -> breakpoint) """
+        info = self._codes.get(code_id)
+        if info is None:
+            return {}
+        return {line: self.breakpoints[line] for line in info.breakpoint_lines}
 
 
 class FileManager:
@@ -91,6 +240,23 @@ class FileManager:
         """ code ids that have breakpoints """
         self.codeinfos_possibly_without_code_objects: Set[CodeId] = set()
         """ code ids that might not have code objects """
+        self._line_index: Dict[Tuple[str, int], Breakpoint] = {}
+        """ (absolute file name, line) -> breakpoint, for the trace function """
+        self._line_maps: Dict[str, bytearray] = {}
+        """
+        absolute file name -> 1 at the index of every breakpoint line,
+        to check lines in the trace function without building a key tuple
+        """
+        self._absolute_file_names: Dict[str, str] = {}
+        """ co_filename -> absolute file name, to create each Path only once """
+        self._code_ids: Dict[int, Tuple[weakref.ref, CodeId]] = {}
+        """
+        id(code) -> (weak reference to the code, code id), the entries are
+        removed when their code object is collected (before its id can be
+        reused), so that code created at runtime isn't kept alive
+        """
+        self._known_code_objects: Dict[CodeId, types.CodeType] = {}
+        """ code objects of the program, known before they are first called """
 
     def __getitem__(self, path: Path) -> DbgFile:
         """ Get the DbgFile for a file """
@@ -107,20 +273,21 @@ class FileManager:
         Find a code object location in a file with the given function name
         that contains the given line number.
 
-        This is does use a regex to find the function definition, so it might
-        not be 100% accurate.
+        The definitions of each file are only searched once (per modification).
         """
-        cre = re.compile(r'def\s+%s+\s*[(]' % re.escape(funcname))
         try:
-            fp = tokenize.open(file)
+            def_lines = _def_index(str(file), file.stat().st_mtime_ns).get(funcname)
         except OSError:
             return None
-        # consumer of this info expects the first line to be 1
-        with fp:
-            for lineno, line_str in enumerate(fp, start=1):
-                if cre.match(line_str) and lineno <= line:
-                    return CodeId(file.absolute(), lineno)
-        return None
+        if not def_lines:
+            return None
+        if line is None:
+            return CodeId.make(file, def_lines[0])
+        # last definition that starts before the line
+        i = bisect.bisect_right(def_lines, line)
+        if i == 0:
+            return None
+        return CodeId.make(file, def_lines[i - 1])
 
     def get_breakpoints(self, file: Path) -> Dict[int, Breakpoint]:
         """ Get all breakpoints in a file (line number -> breakpoint) """
@@ -137,30 +304,61 @@ class FileManager:
 
         line -1 is start line of function
         """
+        if line == -1:
+            line = code_id.start_line + 1
         br = Breakpoint(code_id, line, condition)
-        self[code_id.path].add_breakpoint(br)
+        dbg_file = self[code_id.path]
+        dbg_file.add_breakpoint(br)
+        self._line_index[(str(dbg_file.path), line)] = br
+        line_map = self._line_maps.setdefault(str(dbg_file.path), bytearray())
+        if len(line_map) <= line:
+            line_map.extend(bytes(line + 1 - len(line_map)))
+        line_map[line] = 1
         self.codes_with_breakpoints.add(code_id)
-        if self[code_id.path][code_id].code is None:
+        code_info = dbg_file[code_id]
+        if code_info.code is None:
+            code_info.code = self._known_code_objects.get(code_id)
+        if code_info.code is None:
             self.codeinfos_possibly_without_code_objects.add(code_id)
 
+    def register_code_objects(self, code: types.CodeType):
+        """
+        Register a (compiled module) code object and all nested code objects,
+        so that breakpoints in them don't have to wait for their first call
+        to get their code objects
+        """
+        for co in _walk_code(code):
+            self._known_code_objects[self.code_id(co)] = co
+
     def remove_breakpoint(self, code_id: CodeId, line: int):
         """ Remove a breakpoint at a given line in a given code object """
-        self[code_id.path].remove_breakpoint(Breakpoint(code_id, line))
-        if len(self[code_id.path].breakpoints) == 0:
-            self.codes_with_breakpoints.remove(code_id)
+        dbg_file = self[code_id.path]
+        dbg_file.remove_breakpoint(Breakpoint(code_id, line))
+        self._line_index.pop((str(dbg_file.path), line), None)
+        self._line_maps[str(dbg_file.path)][line] = 0
+        if not dbg_file.has_breakpoints_in_code(code_id):
+            self.codes_with_breakpoints.discard(code_id)
+            self.codeinfos_possibly_without_code_objects.discard(code_id)
 
     def remove_breakpoints(self, file: Path) -> Set[CodeId]:
         """ Remove all breakpoints in a file and return their code ids """
-        mids = set()
-        for br in self.get_breakpoints(file).values():
-            mids.add(br.code)
-            self.remove_breakpoint(br.code, br.line)
-        self._per_file.pop(file)
+        dbg_file = self._per_file.pop(file.absolute(), None)
+        if dbg_file is None:
+            return set()
+        mids = {br.code for br in dbg_file.breakpoints.values()}
+        for line in dbg_file.breakpoints:
+            del self._line_index[(str(dbg_file.path), line)]
+        self._line_maps.pop(str(dbg_file.path), None)
+        self.codes_with_breakpoints -= mids
+        self.codeinfos_possibly_without_code_objects -= mids
         return mids
 
     def remove_all_breakpoints(self) -> Set[CodeId]:
         """ Remove all breakpoints and return their code ids """
         self._per_file.clear()
+        self._line_index.clear()
+        self._line_maps.clear()
+        self.codeinfos_possibly_without_code_objects.clear()
         mids = self.codes_with_breakpoints
         self.codes_with_breakpoints = set()
         return mids
@@ -168,34 +366,72 @@ class FileManager:
     def get_breakpoint(self, code: types.CodeType, line: int) \
             -> Optional[Breakpoint]:
         """ Get the breakpoint at a given line in a given code object """
-        return self[Path(code.co_filename)].breakpoints.get(line)
+        file_name = self._absolute_file_names.get(code.co_filename)
+        if file_name is None:
+            file_name = str(Path(code.co_filename).absolute())
+            self._absolute_file_names[code.co_filename] = file_name
+        line_map = self._line_maps.get(file_name)
+        if line_map is None or line >= len(line_map) or not line_map[line]:
+            return None
+        return self._line_index[(file_name, line)]
 
     def has_breakpoints_in_code(self, code_id: CodeId) -> bool:
         """ Check if a code object has breakpoints """
         return code_id in self.codes_with_breakpoints
 
+    def code_id(self, code: types.CodeType) -> CodeId:
+        """ Get the (cached) code id of a code object """
+        key = id(code)
+        entry = self._code_ids.get(key)
+        if entry is None:
+            code_ids = self._code_ids
+            entry = (weakref.ref(code, lambda _: code_ids.pop(key, None)),
+                     CodeId.make(Path(code.co_filename), code.co_firstlineno))
+            code_ids[key] = entry
+        return entry[1]
+
     def has_breakpoints_in_code_object_and_update(self, code: types.CodeType) \
             -> bool:
         """
         Check if a code object has breakpoints and set the code object if needed
+
+        Debuggers might not call this on every call of the code object
+        (NewDbg disables the PY_START events), so it must not rely on it
         """
-        id = CodeId(Path(code.co_filename).absolute(), code.co_firstlineno)
+        id = self.code_id(code)
         if id in self.codeinfos_possibly_without_code_objects:
             self.set_code_object(id, code)
         return self.has_breakpoints_in_code(id)
 
-    def get_code_info(self, code_id: CodeId) -> CodeInfo:
-        return self[code_id.path][code_id]
+    def get_code_info(self, code_id: CodeId) -> Optional[CodeInfo]:
+        """ Get the code info, if the code object has breakpoints """
+        dbg_file = self._per_file.get(code_id.path)
+        return None if dbg_file is None else dbg_file.get_code_info(code_id)
+
+    def get_code_breakpoints(self, code_id: CodeId) -> Dict[int, Breakpoint]:
+        """ Get the breakpoints in a code object (line number -> breakpoint) """
+        dbg_file = self._per_file.get(code_id.path)
+        return {} if dbg_file is None else dbg_file.get_code_breakpoints(code_id)
+
+    def get_code_object(self, code_id: CodeId) -> Optional[types.CodeType]:
+        """ Get the code object, if it is known """
+        info = self.get_code_info(code_id)
+        if info is not None and info.code is not None:
+            return info.code
+        return self._known_code_objects.get(code_id)
 
 
 class CodeFormatter:
     """ Formats code using pygments if available """
 
     def __init__(self):
+        self._tok_cache: Dict[str, Tuple[int, List[List[Tuple]]]] = {}
+        """ file -> (modification time, pygments tokens of each line) """
         try:
             from pygments import format as pygformat
             from pygments.formatters.terminal import TerminalFormatter
             from pygments.lexers.python import Python3Lexer
+            from pygments.token import Text
 
             # custom terminal formatter for code
             # which let's use a different line number formatter
@@ -215,8 +451,9 @@ class CodeFormatter:
             self.CustomTerminalFormatter = CustomTerminalFormatter
             self.Python3Lexer = Python3Lexer
             self.pygformat = pygformat
+            self.Text = Text
         except ImportError:
-            pass
+            self.Python3Lexer = None
 
     def format(self, code: str,
                line_prefix: Callable[[int], str] = lambda i: "") -> str:
@@ -227,15 +464,39 @@ class CodeFormatter:
         :param line_prefix: a function that returns the prefix for a line number
         """
         if not self.uses_pygments():
-            return "\n".join(
-                line_prefix(i) + l for i, l in enumerate(code.splitlines()))
+            # line numbers start at 1, like the ones of the pygments formatter
+            return "\n".join(line_prefix(i) + l for i, l in
+                             enumerate(code.splitlines(), start=1))
         return self.pygformat(self.Python3Lexer().get_tokens(code),
                               self.CustomTerminalFormatter(line_prefix))
 
+    def _line_tokens(self, code: str, cache_key: Tuple[str, int]) \
+            -> List[List[Tuple]]:
+        """
+        Pygments tokens of each line of the code, the whole code is only
+        lexed once per cache key (file, modification time)
+        """
+        file, mtime = cache_key
+        cached = self._tok_cache.get(file)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        lines: List[List[Tuple]] = [[]]
+        # keep the leading and trailing newlines to align the lines,
+        # every line ends with its newline token
+        for ttype, value in self.Python3Lexer(stripnl=False).get_tokens(code):
+            for part in value.splitlines(keepends=True):
+                lines[-1].append((ttype, part))
+                if part.endswith("\n"):
+                    lines.append([])
+        lines.pop()
+        self._tok_cache[file] = (mtime, lines)
+        return lines
+
     def print_code(self, *, code: str, current_line: int = -1,
                    breakpoints: Dict[int, Breakpoint] = None,
                    header: Optional[str] = None, start_line: int = 1,
-                   end_line: int = -1, code_start_line: int = 1):
+                   end_line: int = -1, code_start_line: int = 1,
+                   cache_key: Optional[Tuple[str, int]] = None):
         """
         Print code on the command line
 
@@ -247,6 +508,8 @@ class CodeFormatter:
         :param start_line: the first line to print
         :param end_line: the last line to print, -1 for the last line
         :param code_start_line: the line number of the first line of the code
+        :param cache_key: (file, modification time) of the code, to reuse
+                          the pygments tokens of previous calls
         """
 
         lines = code.splitlines()
@@ -273,6 +536,19 @@ class CodeFormatter:
 
         if header:
             print(header)
+        if cache_key is not None and self.uses_pygments():
+            line_tokens = self._line_tokens(code, cache_key)
+            if len(line_tokens) == len(lines):
+                tokens = []
+                for line in line_tokens[start_line - code_start_line:end_line]:
+                    if line[0][1] == "\n":
+                        # empty line
+                        tokens.append((self.Text, " "))
+                    tokens.extend(line)
+                print(self.pygformat(tokens,
+                                     self.CustomTerminalFormatter(
+                                         format_line_number)))
+                return
         for i in range(len(subset)):
             if subset[i] == "":
                 subset[i] = " "
@@ -288,12 +564,81 @@ class ShellExit:
     """ exit the program? """
 
 
+class ShellNamespace(dict):
+    """
+    Namespace of the shell, contains the variables defined in the shell
+    and looks up everything else in the passed mappings, without copying
+    them, the first mapping wins: ShellNamespace(f_locals, helpers, f_globals)
+
+    It has to be a dict subclass, as exec only accepts dicts as globals,
+    but calls __missing__ for unknown names
+    """
+
+    def __init__(self, *mappings: dict):
+        super().__init__()
+        self._mappings = ChainMap(*mappings)
+
+    def __missing__(self, key):
+        return self._mappings[key]
+
+    def materialize(self) -> "ShellNamespace":
+        """
+        Namespace that contains the names of all but the last mapping
+        (the globals) directly, for shells like bpython that list the names
+        for their completion, the globals are still looked up lazily
+        """
+        *mappings, last = self._mappings.maps
+        namespace = ShellNamespace(last)
+        for mapping in reversed(mappings):
+            namespace.update(mapping)
+        namespace.update(self)
+        return namespace
+
+
+class Store(types.SimpleNamespace):
+    """
+    Store that is shared between shells, supports attribute access
+    (_st.name, for hot loops) and item access (_st["name"])
+    """
+
+    def __getitem__(self, key):
+        return self.__dict__[key]
+
+    def __setitem__(self, key, value):
+        self.__dict__[key] = value
+
+    def __delitem__(self, key):
+        del self.__dict__[key]
+
+    def __contains__(self, key):
+        return key in self.__dict__
+
+
+class CachedCompile:
+    """
+    codeop.CommandCompiler that caches the code objects of repeated inputs,
+    like context() at every breakpoint
+    """
+
+    def __init__(self):
+        self._compile = lru_cache(maxsize=256)(codeop.CommandCompiler())
+
+    def __call__(self, source: str, filename: str = "<input>",
+                 symbol: str = "single") -> Optional[types.CodeType]:
+        return self._compile(source, filename, symbol)
+
+
+# shared between all consoles, as there is a new console for every shell
+_cached_compile = CachedCompile()
+
+
 class CustomInteractiveConsole(InteractiveConsole):
     """ InteractiveConsole that handles SystemExit properly """
 
     def __init__(self, _locals: dict, filename="<console>"):
         super().__init__(_locals, filename)
         self.locals = _locals
+        self.compile = _cached_compile
 
     def runcode(self, code):
         try:
@@ -315,9 +660,12 @@ class Shell:
             import bpython
             self.bpython = bpython
         except ImportError:
-            pass
+            self.bpython = None
 
     def _fancy_eval(self, _locals: dict, message: str):
+        if isinstance(_locals, ShellNamespace):
+            # bpython lists the locals for its auto completion
+            _locals = _locals.materialize()
         ret = self.bpython.embed(locals_=_locals, banner=message)
         if isinstance(ret, ShellExit):
             if ret.exit_application:
@@ -391,7 +739,7 @@ class Dbg:
     def __init__(self):
         self._main_file: Optional[Path] = None
         self._in_breakpoint = False
-        self._st = {}  # store between evals
+        self._st = Store()  # store between evals
         self.code_formatter = CodeFormatter()
         self.shell = Shell()
         self.manager = FileManager()
@@ -432,7 +780,7 @@ class Dbg:
             return func.__code__ if func else frame.f_code
 
         def _code_id(code: types.CodeType) -> CodeId:
-            return CodeId(Path(code.co_filename), code.co_firstlineno)
+            return self.manager.code_id(code)
 
         helpers = {}
 
@@ -473,12 +821,15 @@ class Dbg:
             if not path.exists():
                 print(f"File {path} does not exist")
                 return
-            code = path.read_text()
+            mtime = path.stat().st_mtime_ns
+            code = _read_text(str(path), mtime)
             self.code_formatter.print_code(code=code, breakpoints=self.manager[
                 Path(file or frame.f_code.co_filename)].breakpoints,
                                            current_line=frame.f_lineno,
                                            start_line=max(1, start),
-                                           end_line=end)
+                                           end_line=end,
+                                           cache_key=(str(path.absolute()),
+                                                      mtime))
 
         @func
         def context(pre: int = 4, post: int = 4):
@@ -494,23 +845,35 @@ class Dbg:
             show()
 
         @func
-        def stacktrace():
-            """ Show stacktrace """
-            print("".join(traceback.format_stack(frame)))
+        def stacktrace(source: bool = True):
+            """
+            Show stacktrace, source (default:True) to show the source lines
+            """
+            # walk the frames, only reads the files for the source lines
+            entries = []
+            f = frame
+            while f:
+                co = f.f_code
+                entry = (f'  File "{co.co_filename}", line {f.f_lineno}, '
+                         f'in {co.co_name}\n')
+                if source:
+                    line = linecache.getline(co.co_filename, f.f_lineno,
+                                             f.f_globals).strip()
+                    if line:
+                        entry += f"    {line}\n"
+                entries.append(entry)
+                f = f.f_back
+            print("".join(reversed(entries)))
 
         @func
         def show_function(func: Callable = None):
             """
             show code of function, func (default:None) current function
             """
-            if func is None:
-                co = frame.f_code
-                file = None
-            else:
-                co = func.__code__
-                file = inspect.getsourcefile(func)
-            show(file, start=co.co_firstlineno, end=co.co_firstlineno + len(
-                inspect.getsource(co).splitlines()) - 1)
+            co = _code_object(func)
+            # the end line is exclusive
+            show(co.co_filename, start=co.co_firstlineno,
+                 end=_last_line(co) + 1)
 
         @func
         def break_at_func(func: Union[Callable, str] = None, line: int = -1,
@@ -540,7 +903,7 @@ class Dbg:
             if not path.exists():
                 print(f"File {path} does not exist")
                 return
-            code_id = self.manager.find_code(Path(file), func,
+            code_id = self.manager.find_code(path, func,
                                              line if line != -1 else None)
             if code_id is not None:
                 self.manager.add_breakpoint(code_id, line, condition)
@@ -615,7 +978,7 @@ class Dbg:
         def dbg_help():
             """ Show this help """
             parts = {"_h": "Dict with all helper functions",
-                     "_st": "Store dict, shared between shells",
+                     "_st": "Store, shared between shells, _st.name or _st['name']",
                      "_frame": "Current frame", "_dbg": "Debugger"}
             for k, v in helpers.items():
                 if not isinstance(v, Callable):
@@ -639,7 +1002,8 @@ class Dbg:
         message = f"{reason} at {location}"
         if show_context:
             context()
-        self.shell.eval(_locals=frame.f_locals | helpers | frame.f_globals,
+        self.shell.eval(_locals=ShellNamespace(frame.f_locals, helpers,
+                                               frame.f_globals),
                         message=message)
         if self._single_step_instead_of_continue != StepMode.none:
             _step_setup(self._single_step_instead_of_continue)
@@ -659,17 +1023,33 @@ class Dbg:
     def _process_compiled_code(self, code: types.CodeType):
         pass
 
-    def run(self, file: Path):
-        """ Run a given file with the debugger """
+    def run(self, file: Path, optimize: int = -1):
+        """
+        Run a given file with the debugger,
+        optimize is the optimization level passed to compile
+        """
         self._main_file = file
         # see https://realpython.com/python-exec/#using-python-for-configuration-files
-        compiled = compile(file.read_text(), filename=str(file), mode='exec')
+        # shares the cached text with the show helper
+        source = _read_text(str(file), file.stat().st_mtime_ns)
+        compiled = compile(source, filename=str(file), mode='exec',
+                           optimize=optimize)
         sys.argv.pop(0)
         sys.breakpointhook = self._breakpoint
+        self.manager.register_code_objects(compiled)
         self._process_compiled_code(compiled)
         exec(compiled, _globals | {"__name__": "__main__", "__file__": str(file)})
 
 
+def _is_step_frame(frame: types.FrameType,
+                   step_frame: types.FrameType) -> bool:
+    return frame == step_frame
+
+
+def _always_step(frame: types.FrameType, step_frame: types.FrameType) -> bool:
+    return True
+
+
 class SetTraceDbg(Dbg):
     """
     sys.settrace based debugger
@@ -677,43 +1057,87 @@ class SetTraceDbg(Dbg):
 
     def __init__(self):
         super().__init__()
+        self._step_dispatch: Dict[Tuple[StepMode, str],
+                                  Callable[[types.FrameType,
+                                            types.FrameType], bool]] = {}
+        """ (step mode, event) -> check whether to handle the step """
+        for event in ('call', 'line', 'return', 'exception'):
+            self._step_dispatch[(StepMode.over, event)] = _is_step_frame
+            self._step_dispatch[(StepMode.into, event)] = _always_step
+        self._step_dispatch[(StepMode.out, 'return')] = _is_step_frame
+        paths = sysconfig.get_paths()
+        self._skip_prefixes = (__file__,) + tuple(
+            os.path.join(paths[name], '') for name in ('stdlib', 'platstdlib'))
+        """
+        files of the debugger and the standard library,
+        calls into them are only traced if they have breakpoints
+        """
+        self._trace_prefixes = tuple(
+            os.path.join(paths[name], '') for name in ('purelib', 'platlib'))
+        """ installed packages, traced even if they lie in the standard library """
         sys.settrace(self._dispatch_trace)
 
-    def _should_break_at(self, frame: types.FrameType) -> bool:
-        breakpoint = self.manager.get_breakpoint(frame.f_code, frame.f_lineno)
+    def _should_break_at(self, frame: types.FrameType,
+                         code: types.CodeType) -> bool:
+        breakpoint = self.manager.get_breakpoint(code, frame.f_lineno)
         if breakpoint is not None:
-            return breakpoint.test(frame.f_globals, frame.f_locals)
+            return breakpoint.test_frame(frame)
         return False
 
-    def _handle_line(self, frame: types.FrameType):
-        if self._should_break_at(frame):
+    def _handle_line(self, frame: types.FrameType, code: types.CodeType):
+        if self._should_break_at(frame, code):
             self._breakpoint(frame, reason="breakpoint")
 
-    def _default_dispatch(self, event):
-        if event == 'call':
+    def _post_process(self, modified_code_ids: Set[CodeId]):
+        # not all frames are traced, so trace the stepped frame
+        # and the frames on the stack that got breakpoints in the shell
+        if self._single_step is not None:
+            self._single_step.frame.f_trace = self._dispatch_trace
+        if modified_code_ids:
+            frame = sys._getframe(1)
+            while frame:
+                if self.manager.has_breakpoints_in_code_object_and_update(
+                        frame.f_code):
+                    frame.f_trace = self._dispatch_trace
+                frame = frame.f_back
+
+    def _default_dispatch(self, frame: types.FrameType, event):
+        # only trace the lines of code with breakpoints or when stepping into,
+        # returning None disables the line events for all other frames
+        if event == 'call' and (
+                (self._single_step is not None and
+                 self._single_step.mode == StepMode.into) or
+                self.manager.has_breakpoints_in_code_object_and_update(
+                    frame.f_code)):
             return self._dispatch_trace
+        return None
 
     def _should_single_step(self, frame: types.FrameType, event) -> bool:
         if not self._single_step:
             return False
-        if self._single_step.mode == StepMode.over:
-            return frame == self._single_step.frame
-        if self._single_step.mode == StepMode.into:
-            return True
-        if self._single_step.mode == StepMode.out and event == 'return':
-            return frame == self._single_step.frame
-        return False
+        check = self._step_dispatch.get((self._single_step.mode, event))
+        return check is not None and check(frame, self._single_step.frame)
 
     def _dispatch_trace(self, frame: types.FrameType, event, _):
+        if self._in_breakpoint:
+            # the shell of breakpoint() runs outside the trace function
+            return None
+        code = frame.f_code
+        co_filename = code.co_filename
+        if event == 'call' and co_filename.startswith(self._skip_prefixes) \
+                and not co_filename.startswith(self._trace_prefixes) \
+                and not self.manager.has_breakpoints_in_code_object_and_update(
+                    code):
+            return None
         if (
-                event == 'return' and frame.f_code.co_name == '<module>' and
+                event == 'return' and code.co_name == '<module>' and
                 frame.f_back and frame.f_back.f_code.co_filename == __file__):
             return
-        if self._is_first_call and self._main_file == Path(
-                frame.f_code.co_filename):
+        # the main file is compiled with str(file) as its file name
+        if self._is_first_call and co_filename == str(self._main_file):
             self._is_first_call = False
             self._breakpoint(frame, show_context=False, reason="start")
-            return self._default_dispatch(event)
+            return self._default_dispatch(frame, event)
         if self._should_single_step(frame, event):
             if event == 'return':
                 if frame.f_back:
@@ -723,17 +1147,14 @@ class SetTraceDbg(Dbg):
             if self._single_step.mode == StepMode.out:
                 return
             if event == 'line':
-                self._single_step.mode = None
+                # the step is done
+                self._single_step = None
                 self._breakpoint(frame, reason="step")
                 return
         if event == 'call':
-            if self.manager.has_breakpoints_in_code_object_and_update(
-                    frame.f_code) is not None:
-                return self._dispatch_trace
-            else:
-                return self._default_dispatch(event)
+            return self._default_dispatch(frame, event)
         elif event == 'line':
-            self._handle_line(frame)
+            self._handle_line(frame, code)
 
 
 if __name__ == '__main__':
@@ -741,12 +1162,18 @@ if __name__ == '__main__':
     argparser.add_argument("file", help="file to debug")
     argparser.add_argument("args", nargs="*",
                            help="arguments to pass to file")
+    argparser.add_argument("--optimize", type=int, choices=[0, 1, 2],
+                           default=-1,
+                           help="optimization level of the file, "
+                                "2 removes asserts and docstrings")
     args = argparser.parse_args()
+    # the file should only see its own arguments
+    sys.argv = [sys.argv[0], args.file, *args.args]
     dbg = SetTraceDbg()
     print("Tiny debugger https://github.com/parttimenerd/python-dbg/")
     if not dbg.uses_bpython():
         print("Install bpython for a better debugging experience")
     try:
-        dbg.run(Path(args.file))
+        dbg.run(Path(args.file), optimize=args.optimize)
     except KeyboardInterrupt:
         pass
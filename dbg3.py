@@ -3,8 +3,10 @@ import argparse
 import types
 from pathlib import Path
 from types import CodeType
-from typing import Set, Union, Literal
+from typing import Dict, Set, Union, Literal
 import sys
+import weakref
+from weakref import WeakKeyDictionary
 
 import dbg2
 from dbg2 import CodeId
@@ -12,6 +14,7 @@ from dbg2 import CodeId
 # some aliases
 mon = sys.monitoring
 E = mon.events
+DISABLE = mon.DISABLE
 
 
 class NewDbg(dbg2.Dbg):
@@ -22,7 +25,17 @@ class NewDbg(dbg2.Dbg):
     def __init__(self, tool_id: int = mon.DEBUGGER_ID):
         super().__init__()
         self.tool_id = tool_id
-        self.code_objects_with_local_events = set()
+        self.code_objects_with_local_events: Dict[int, weakref.ref] = {}
+        """
+        id(code) -> weak reference to the code, for the code objects with
+        local events, the entry is removed when the code object dies
+        """
+        self._code_breakpoints: WeakKeyDictionary[
+            CodeType, Dict[int, dbg2.Breakpoint]] = WeakKeyDictionary()
+        """ code object with breakpoints -> line -> breakpoint """
+        self._ignored_filenames = frozenset(
+            {sys.intern(__file__), sys.intern(dbg2.__file__)})
+        """ files of the debugger itself """
         # register the tool
         mon.use_tool_id(self.tool_id, "dbg")
         # register callbacks for the events we are interested in
@@ -40,96 +53,159 @@ class NewDbg(dbg2.Dbg):
     def _should_single_step(self, frame: types.FrameType,
                             event: Union[Literal['return'], Literal['line']]) \
             -> bool:
-        if not self._single_step:
+        step = self._single_step
+        if step is None:
             return False
-        if self._single_step.mode == dbg2.StepMode.over:
+        mode = step.mode
+        if mode is dbg2.StepMode.over:
             # ignore frames other than the one we are stepping in
             # when we're stepping over
-            return frame == self._single_step.frame
-        if self._single_step.mode == dbg2.StepMode.into:
+            return frame is step.frame
+        if mode is dbg2.StepMode.into:
             # we are always stepping if we're stepping into
             return True
-        if self._single_step.mode == dbg2.StepMode.out and event == 'return':
-            # we are stepping if we're stepping out and we have a return event
-            return frame == self._single_step.frame
-        return False
+        # we are stepping if we're stepping out and we have a return event
+        return mode is dbg2.StepMode.out and event == 'return' and \
+            frame is step.frame
 
+    # the keyword only defaults are locals of the handlers,
+    # which are faster to access than globals
     def return_handler(self, code: CodeType, instruction_offset: int,
-                       retval: object):
-        frame = sys._getframe(1)
-        if self._should_single_step(frame, 'return'):
-            if frame.f_back:
-                self._single_step.frame = frame.f_back
-                self._breakpoint(frame.f_back, reason="step")
-            return
+                       retval: object, *, _getframe=sys._getframe,
+                       _DISABLE=DISABLE):
+        # _single_step is None when we're not stepping
+        step = self._single_step
+        if step is not None:
+            frame = _getframe(1)
+            if self._should_single_step(frame, 'return'):
+                if frame.f_back:
+                    step.frame = frame.f_back
+                    self._breakpoint(frame.f_back, reason="step")
+                return
         if not self.manager.has_breakpoints_in_code_object_and_update(code):
             # disable local events if we have no breakpoints
             # we need this because step-into might have enabled local events
             self.disable_local_events(code)
+        elif step is None:
+            # only stepping needs return events,
+            # _post_process restarts them when stepping starts
+            return _DISABLE
 
-    def line_handler(self, code: CodeType, line_number: int):
+    def line_handler(self, code: CodeType, line_number: int, *,
+                     _getframe=sys._getframe, _DISABLE=DISABLE):
         """ Handler for the LINE event """
-        frame = sys._getframe(1)
         if self._is_first_call:
-            if code == self._initial_code_object:
+            if code is self._initial_code_object:
                 # we are in the first call
                 self._is_first_call = False
                 # run the start shell
-                self._breakpoint(frame, reason="start")
+                self._breakpoint(_getframe(1), reason="start")
             return
-        if (br := self.manager.get_breakpoint(code, line_number)) is not None:
+        step = self._single_step
+        breakpoints = self._code_breakpoints.get(code)
+        if breakpoints is not None and \
+                (br := breakpoints.get(line_number)) is not None:
             # we have a breakpoint
-            if br.test(frame.f_globals, frame.f_locals):
+            frame = _getframe(1)
+            if br.test_frame(frame):
                 # breakpoint is enabled
                 self._breakpoint(frame)
                 return
+        elif step is None:
+            # no breakpoint at this line and not stepping, disable the event
+            # for this location till _post_process restarts the events
+            return _DISABLE
+        if step is None:
+            return
+        frame = _getframe(1)
         if self._should_single_step(frame, 'line'):
             # we are in single step mode
-            if self._single_step.mode == dbg2.StepMode.out:
+            if step.mode is dbg2.StepMode.out:
                 return
-            self._single_step.mode = None
+            # the step is done
+            self._single_step = None
             self._breakpoint(frame, reason="step")
 
-    def start_handler(self, code: CodeType, instruction_offset: int):
+    def start_handler(self, code: CodeType, instruction_offset: int, *,
+                      _DISABLE=DISABLE):
         """ Handler for the PY_START event """
-        if (self._is_first_call or code.co_filename == __file__
-                or code.co_filename == dbg2.__file__):
-            # we are in the first call, or in this file, or in dbg2.py
+        if self._is_first_call:
             return
-        if self.manager.has_breakpoints_in_code_object_and_update(code) or \
-                (self._single_step and
-                 (self._single_step.frame.f_code == code or
-                  self._single_step.mode == dbg2.StepMode.into)):
+        if code.co_filename in self._ignored_filenames:
+            # we are in this file or in dbg2.py, don't call us again for it
+            return _DISABLE
+        step = self._single_step
+        has_breakpoints = \
+            self.manager.has_breakpoints_in_code_object_and_update(code)
+        if has_breakpoints and code not in self._code_breakpoints:
+            # first call of code that got breakpoints before it was known
+            self._update_code_breakpoints(code)
+            self.enable_local_events(code)
+        elif has_breakpoints or \
+                (step is not None and
+                 (step.frame.f_code is code or
+                  step.mode is dbg2.StepMode.into)):
             # enable events for this code object if we have breakpoints
             self.enable_local_events(code)
+        if step is None:
+            # the local events of code with breakpoints stay enabled,
+            # _post_process restarts the events for new breakpoints and steps
+            return _DISABLE
+
+    def _update_code_breakpoints(self, code: CodeType) -> bool:
+        """
+        Update the breakpoints of the code object for the line handler,
+        returns whether the code object has breakpoints
+        """
+        breakpoints = self.manager.get_code_breakpoints(
+            self.manager.code_id(code))
+        if breakpoints:
+            self._code_breakpoints[code] = breakpoints
+            return True
+        self._code_breakpoints.pop(code, None)
+        return False
 
     def enable_local_events(self, code: CodeType):
         """ Enable line events for a specific code object if needed """
-        if code in self.code_objects_with_local_events:
+        code_id = id(code)
+        if code_id in self.code_objects_with_local_events:
             return
         mon.set_local_events(self.tool_id, code, E.LINE | E.PY_RETURN)
-        self.code_objects_with_local_events.add(code)
+        codes = self.code_objects_with_local_events
+        codes[code_id] = weakref.ref(
+            code, lambda _, code_id=code_id: codes.pop(code_id, None))
 
     def disable_local_events(self, code: CodeType):
         """ Disable all local events for a specific code object if needed """
-        if code not in self.code_objects_with_local_events:
+        if self.code_objects_with_local_events.pop(id(code), None) is None:
             return
         mon.set_local_events(self.tool_id, code, 0)
-        self.code_objects_with_local_events.discard(code)
 
     def _post_process(self, modified_code_ids: Set[CodeId]):
+        # the code objects that had breakpoints and the ones that got them
+        codes = {code for code in self._code_breakpoints
+                 if self.manager.code_id(code) in modified_code_ids}
         for code_id in modified_code_ids:
-            info = self.manager.get_code_info(code_id)
-            if info is None or info.code is None:
-                continue
-            if info.breakpoints:
-                # enable local events if we have breakpoints
-                self.enable_local_events(info.code)
+            code = self.manager.get_code_object(code_id)
+            if code is not None:
+                codes.add(code)
+        # update all breakpoints before changing the instrumentation
+        to_enable = []
+        to_disable = []
+        for code in codes:
+            if self._update_code_breakpoints(code):
+                to_enable.append(code)
             else:
-                # disable local events if we have no breakpoints
-                self.disable_local_events(info.code)
-        if self._single_step:
+                to_disable.append(code)
+        for code in to_disable:
+            self.disable_local_events(code)
+        for code in to_enable:
+            self.enable_local_events(code)
+        if self._single_step is not None:
             self.enable_local_events(self._single_step.frame.f_code)
+        if modified_code_ids or self._single_step is not None:
+            # enable the events that returned DISABLE
+            mon.restart_events()
 
 
 if __name__ == '__main__':
@@ -137,12 +213,18 @@ if __name__ == '__main__':
     argparser.add_argument("file", help="file to debug")
     argparser.add_argument("args", nargs="*",
                            help="arguments to pass to file")
+    argparser.add_argument("--optimize", type=int, choices=[0, 1, 2],
+                           default=-1,
+                           help="optimization level of the file, "
+                                "2 removes asserts and docstrings")
     args = argparser.parse_args()
+    # the file should only see its own arguments
+    sys.argv = [sys.argv[0], args.file, *args.args]
     dbg = NewDbg()
     print("Tiny debugger https://github.com/parttimenerd/python-dbg/")
     if not dbg.uses_bpython():
         print("Install bpython for a better debugging experience")
     try:
-        dbg.run(Path(args.file))
+        dbg.run(Path(args.file), optimize=args.optimize)
     except KeyboardInterrupt:
         pass
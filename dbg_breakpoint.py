@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 import inspect
-import traceback
+import linecache
 from dataclasses import dataclass
-from typing import Callable, Optional, List
+from functools import lru_cache
+from typing import Callable, Optional, List, Dict, Tuple
 
 _globals = globals().copy()
 
@@ -11,6 +12,8 @@ from code import InteractiveConsole
 import sys
 from pathlib import Path
 
+from dbg2 import CachedCompile, ShellNamespace, Store, _last_line, _read_text
+
 
 @dataclass
 class DbgContinue:
@@ -18,12 +21,17 @@ class DbgContinue:
     """ exit the program? """
 
 
+# shared between all consoles, as there is a new console for every breakpoint
+_cached_compile = CachedCompile()
+
+
 # handles DbgContinue properly
 class CustomInteractiveConsole(InteractiveConsole):
 
     def __init__(self, _locals: dict, filename="<console>"):
         super().__init__(_locals, filename)
         self.locals = _locals
+        self.compile = _cached_compile
 
     def runcode(self, code):
         try:
@@ -39,12 +47,17 @@ class Dbg:
     def __init__(self):
         self._skip_count = 0
         self._in_breakpoint = False
-        self._st = {}  # store between evals
+        self._st = Store()  # store between evals
+        self._help_parts: Optional[Dict[str, str]] = None  # built by the first dbg_help call
+        # repeated stops at the same location print the same code
+        self._format_cached = lru_cache(maxsize=64)(self._format)
         self.bpython = None
-        # the default code formatter does not highlight the code
+        self._static_helpers = {"cont": self._cont, "skip_breaks": self._skip_breaks, "exit": self._exit}
+        # the default code formatter does not highlight the code,
+        # line numbers start at 1, like the ones of the pygments formatter
         self.code_formatter: Callable[[str, Callable[[int], str]], str] = \
             lambda code, line_prefix: "\n".join(line_prefix(i) + l
-                                                for i, l in enumerate(code.splitlines()))
+                                                for i, l in enumerate(code.splitlines(), start=1))
         try:
             import bpython
             self.bpython = bpython
@@ -93,6 +106,14 @@ class Dbg:
                    code_start_line: int = 1):
         subset = code.rstrip().splitlines()[start_line - code_start_line:max(end_line - code_start_line, end_line)]
         max_line_number_digits = min(len(str(max(end_line, code_start_line + len(subset)))), 4)
+
+        if header:
+            print(header)
+        print(self._format_cached("\n".join(subset), start_line, current_line,
+                                  None if breakpoints is None else tuple(breakpoints), max_line_number_digits))
+
+    def _format(self, code: str, start_line: int, current_line: int, breakpoints: Optional[Tuple[int, ...]],
+                max_line_number_digits: int) -> str:
         has_prefix = current_line >= 0 or breakpoints
 
         def format_line_number(relative_line_number: int):
@@ -105,11 +126,12 @@ class Dbg:
                 suffix = ("*" if breakpoints is not None and line_number in breakpoints else " ") + " "
             return prefix + line_number_part + suffix
 
-        if header:
-            print(header)
-        print(self.code_formatter("\n".join(subset), format_line_number))
+        return self.code_formatter(code, format_line_number)
 
     def _fancy_eval(self, _locals: dict, message: str):
+        if isinstance(_locals, ShellNamespace):
+            # bpython lists the locals for its auto completion
+            _locals = _locals.materialize()
         ret = self.bpython.embed(locals_=_locals, banner=message)
         if isinstance(ret, DbgContinue):
             if ret.exit:
@@ -118,6 +140,19 @@ class Dbg:
             exit(ret)
         return
 
+    def _cont(self):
+        """continue the program execution"""
+        raise SystemExit(DbgContinue(exit=False))
+
+    def _skip_breaks(self, count: int):
+        """skip breakpoints"""
+        self._skip_count = count
+        self._cont()
+
+    def _exit(self):
+        """exit the program"""
+        raise SystemExit(DbgContinue(exit=True))
+
     def _simple_eval(self, _locals: dict, message: str):
         try:
             print(message)
@@ -135,36 +170,15 @@ class Dbg:
         else:
             self._simple_eval(_locals, message)
 
-    def _breakpoint(self, *args, **kwargs):
-        if self._in_breakpoint or self._skip_count < 0:
-            return
-        if self._skip_count > 0:
-            self._skip_count -= 1
-            return
-        frame = sys._getframe(1)
-
-        helpers = {}
+    def _build_helpers(self, frame) -> dict:
+        """ helper functions (and values) for the shell at the frame """
+        # the helpers that don't use the frame are only created once
+        helpers = {**self._static_helpers}
 
         def func(f: Callable) -> Callable:
             helpers[f.__name__.lstrip('_')] = f
             return f
 
-        @func
-        def _cont():
-            """continue the program execution"""
-            raise SystemExit(DbgContinue(exit=False))
-
-        @func
-        def skip_breaks(count: int):
-            """skip breakpoints"""
-            self._skip_count = count
-            _cont()
-
-        @func
-        def _exit():
-            """exit the program"""
-            raise SystemExit(DbgContinue(exit=True))
-
         @func
         def _locals():
             """show local variables"""
@@ -179,7 +193,8 @@ class Dbg:
 
         def show(file=None, start=1, end=-1, header=None):
             """show code"""
-            code = Path(file or frame.f_code.co_filename).read_text()
+            path = Path(file or frame.f_code.co_filename)
+            code = _read_text(str(path), path.stat().st_mtime_ns)
             self.print_code(code=code,
                             current_line=frame.f_lineno,
                             start_line=max(1, start),
@@ -197,9 +212,20 @@ class Dbg:
             show()
 
         @func
-        def stacktrace():
-            """show stacktrace"""
-            print("".join(traceback.format_stack(frame)))
+        def stacktrace(source=True):
+            """show stacktrace, source (default:True) to show the source lines"""
+            # walk the frames ourselves, so the files are only read for the source lines
+            entries = []
+            f = frame
+            while f:
+                entry = f'  File "{f.f_code.co_filename}", line {f.f_lineno}, in {f.f_code.co_name}\n'
+                if source:
+                    line = linecache.getline(f.f_code.co_filename, f.f_lineno, f.f_globals).strip()
+                    if line:
+                        entry += f"    {line}\n"
+                entries.append(entry)
+                f = f.f_back
+            print("".join(reversed(entries)))
 
         @func
         def show_function(func=None):
@@ -210,19 +236,23 @@ class Dbg:
             else:
                 co = func.__code__
                 file = inspect.getsourcefile(func)
-            show(file, start=co.co_firstlineno, end=co.co_firstlineno + len(inspect.getsource(co).splitlines()) - 1)
+            show(file, start=co.co_firstlineno, end=_last_line(co))
 
         @func
         def dbg_help():
             """show this help"""
-            parts = {"_h": "dict with all helper functions",
-                     "_st": "store dict, shared between shells",
-                     "_frame": "current frame"}
-            for k, v in helpers.items():
-                if not isinstance(v, Callable):
-                    continue
-                name = "{:<20}".format(f"{k}({','.join(inspect.signature(v).parameters.keys())})")
-                parts[name] = inspect.getdoc(v)
+            # the helpers are the same in every shell, so the help is too
+            if self._help_parts is None:
+                parts = {"_h": "dict with all helper functions",
+                         "_st": "store, shared between shells, _st.name or _st['name']",
+                         "_frame": "current frame"}
+                for k, v in helpers.items():
+                    if not isinstance(v, Callable):
+                        continue
+                    name = "{:<20}".format(f"{k}({','.join(inspect.signature(v).parameters.keys())})")
+                    parts[name] = inspect.getdoc(v)
+                self._help_parts = parts
+            parts = self._help_parts
             longest = max(len(k) for k in parts.keys())
             print("  Ctrl-D to continue")
             for k, v in parts.items():
@@ -231,16 +261,32 @@ class Dbg:
         helpers["_st"] = self._st
         helpers["_frame"] = frame
         helpers["_h"] = helpers
+        return helpers
+
+    def _breakpoint(self, *args, **kwargs):
+        if self._in_breakpoint:
+            return
+        skip_count = self._skip_count
+        if skip_count:
+            # negative counts skip all breakpoints
+            if skip_count > 0:
+                self._skip_count = skip_count - 1
+            return
+        frame = sys._getframe(1)
+        helpers = self._build_helpers(frame)
+        location = helpers["location"]()
 
         self._in_breakpoint = True
         message = f"breakpoint at {location}"
-        self._eval(_locals=frame.f_locals | helpers | frame.f_globals, message=message)
+        self._eval(_locals=ShellNamespace(frame.f_locals, helpers, frame.f_globals), message=message)
 
         self._in_breakpoint = False
 
-    def run(self, file: Path):
+    def run(self, file: Path, optimize: int = -1):
         # see https://realpython.com/python-exec/#using-python-for-configuration-files
-        compiled = compile(file.read_text(), filename=file.name, mode='exec')
+        # shares the cached text with the show helpers
+        code = _read_text(str(file), file.stat().st_mtime_ns)
+        compiled = compile(code, filename=file.name, mode='exec', optimize=optimize)
         sys.argv.pop(0)
         sys.breakpointhook = self._breakpoint
         exec(compiled, _globals)
@@ -250,9 +296,13 @@ if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
     argparser.add_argument("file", help="file to debug")
     argparser.add_argument("args", nargs="*", help="arguments to pass to file")
+    argparser.add_argument("--optimize", type=int, choices=[0, 1, 2], default=-1,
+                           help="optimization level of the file, 2 removes asserts and docstrings")
     args = argparser.parse_args()
+    # the file should only see its own arguments
+    sys.argv = [sys.argv[0], args.file, *args.args]
     dbg = Dbg()
     try:
-        dbg.run(Path(args.file))
+        dbg.run(Path(args.file), optimize=args.optimize)
     except KeyboardInterrupt:
         pass
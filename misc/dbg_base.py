@@ -11,9 +11,9 @@ class DbgQuit(RuntimeError):
 
 class Dbg:
 
-    def run(self, file: Path):
+    def run(self, file: Path, optimize: int = -1):
         # see https://realpython.com/python-exec/#using-python-for-configuration-files
-        compiled = compile(file.read_text(), filename=file.name, mode='exec')
+        compiled = compile(file.read_text(), filename=file.name, mode='exec', optimize=optimize)
         sys.argv.pop(0)
         # set stuff here
         try:
@@ -26,10 +26,14 @@ if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
     argparser.add_argument("file", help="file to debug")
     argparser.add_argument("args", nargs="*", help="arguments to pass to file")
+    argparser.add_argument("--optimize", type=int, choices=[0, 1, 2], default=-1,
+                           help="optimization level of the file, 2 removes asserts and docstrings")
     args = argparser.parse_args()
+    # the file should only see its own arguments
+    sys.argv = [sys.argv[0], args.file, *args.args]
     dbg = Dbg()
     try:
-        dbg.run(Path(args.file))
+        dbg.run(Path(args.file), optimize=args.optimize)
     except DbgQuit:
         pass
     except KeyboardInterrupt:
@@ -1,9 +1,8 @@
 # no instrumentation
 import sys
 import types
-from pathlib import Path
 
-from util import shell
+from util import shell, file_stem
 
 
 def at_breakpoint(file: str, line: int) -> bool:
@@ -11,14 +10,14 @@ def at_breakpoint(file: str, line: int) -> bool:
 
 
 def dbg_shell(frame: types.FrameType):
-    shell(_locals=frame.f_locals | {"frame": frame},
-          _globals=frame.f_globals)
+    shell(_locals=frame.f_locals, _globals=frame.f_globals,
+          helpers={"frame": frame})
 
 
 def dbg():
     frame = sys._getframe(1)
     line = frame.f_lineno
-    file = Path(frame.f_code.co_filename).stem
+    file = file_stem(frame.f_code.co_filename)
     print(
         f"hit {file:30}: {line:3d} {frame.f_code.co_name}")
     if at_breakpoint(file, line):
@@ -1,10 +1,17 @@
 # initial sys.settrace
 import sys
+from pathlib import Path
 from types import FrameType
 
 
+# co_filename of the presentation files, checked instead of searching
+# every file name for 'presentation'
+PRESENTATION_FILES = frozenset(str(p.absolute())
+                               for p in Path(__file__).parent.glob("*.py"))
+
+
 def handler(frame: FrameType, event: str, arg):
-    if 'presentation' not in frame.f_code.co_filename:
+    if frame.f_code.co_filename not in PRESENTATION_FILES:
         return
     print(f"event: {event} {frame.f_code.co_name}")
 
@@ -1,9 +1,16 @@
 # line events
 import sys
+from pathlib import Path
 from types import FrameType
 from typing import Optional, Any, Callable
 
 
+# co_filename of the presentation files, checked instead of searching
+# every file name for 'presentation'
+PRESENTATION_FILES = frozenset(str(p.absolute())
+                               for p in Path(__file__).parent.glob("*.py"))
+
+
 def inner_handler(frame: FrameType, event: str, arg):
     print(
         f"inner: {event} {frame.f_code.co_name} {frame.f_lineno}")
@@ -11,7 +18,7 @@ def inner_handler(frame: FrameType, event: str, arg):
 
 def handler(frame: FrameType, event: str, arg) \
         -> Optional[Callable[[FrameType, str, Any], None]]:
-    if 'presentation' not in frame.f_code.co_filename:
+    if frame.f_code.co_filename not in PRESENTATION_FILES:
         return
     print(f"event: {event} {frame.f_code.co_name}")
     return inner_handler
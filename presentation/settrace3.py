@@ -1,22 +1,31 @@
 # first breakpoint
 import sys
 from pathlib import Path
-from types import FrameType
+from types import CodeType, FrameType
 from typing import Optional, Any, Callable
 
-from util import shell
+from util import shell, file_stem
+
+
+# co_filename of the presentation files, checked instead of searching
+# every file name for 'presentation'
+PRESENTATION_FILES = frozenset(str(p.absolute())
+                               for p in Path(__file__).parent.glob("*.py"))
+
+# print every traced event, the breakpoint hits are always printed
+LOG_EVENTS = False
 
 
 def dbg_shell(frame: FrameType):
-    shell(_locals=frame.f_locals | {"frame": frame},
-          _globals=frame.f_globals)
+    shell(_locals=frame.f_locals, _globals=frame.f_globals,
+          helpers={"frame": frame})
 
 
 def inner_handler(frame: FrameType, event: str, arg):
     if event != 'line':
         return
     line = frame.f_lineno
-    file = Path(frame.f_code.co_filename).stem
+    file = file_stem(frame.f_code.co_filename)
     if at_breakpoint(file, line):
         print(f"in break point at line {line}")
         dbg_shell(frame)
@@ -26,12 +35,21 @@ def at_breakpoint(file: str, line: int) -> bool:
     return file == "counter" and line == 6
 
 
+def has_breakpoint(code: CodeType) -> bool:
+    # line events are only needed for code with a breakpoint
+    file = file_stem(code.co_filename)
+    return any(at_breakpoint(file, line)
+               for _, _, line in code.co_lines() if line is not None)
+
+
 def handler(frame: FrameType, event: str, arg) \
         -> Optional[Callable[[FrameType, str, Any], None]]:
-    if 'presentation' not in frame.f_code.co_filename:
+    if frame.f_code.co_filename not in PRESENTATION_FILES:
         return
-    print(f"event: {event} {frame.f_code.co_name}")
-    return inner_handler
+    if LOG_EVENTS:
+        print(f"event: {event} {frame.f_code.co_name}")
+    if has_breakpoint(frame.f_code):
+        return inner_handler
 
 
 sys.settrace(handler)
@@ -1,44 +1,61 @@
 # first breakpoint
 import sys
-from dataclasses import dataclass
 from pathlib import Path
-from types import FrameType
-from typing import Optional, Any, Callable, Set
+from types import CodeType, FrameType
+from typing import Optional, Any, Callable, Set, Dict, FrozenSet
 
-from util import shell
+from util import shell, file_stem
 
 
-@dataclass(frozen=True)
-class Breakpoint:
-    file: str
-    line: int
+# co_filename of the presentation files, checked instead of searching
+# every file name for 'presentation'
+PRESENTATION_FILES = frozenset(str(p.absolute())
+                               for p in Path(__file__).parent.glob("*.py"))
+
+# print every traced event, the breakpoint hits are always printed
+LOG_EVENTS = False
 
 
 first_line = True
-breakpoints: Set[Breakpoint] = set()
+# file -> lines, so that checking a line doesn't create any objects
+breakpoints: Dict[str, Set[int]] = {}
+_EMPTY: FrozenSet[int] = frozenset()
 
 
-def dbg_shell(frame: FrameType):
-    global breakpoints
+def add_breakpoint(file: str, line: int):
+    breakpoints.setdefault(file, set()).add(line)
+    # the running frames of the file might not trace their lines yet,
+    # as the handler only decides this when they are called
+    frame = sys._getframe(1)
+    while frame:
+        if file_stem(frame.f_code.co_filename) == file:
+            frame.f_trace = inner_handler
+        frame = frame.f_back
+
+
+def remove_breakpoint(file: str, line: int):
+    lines = breakpoints[file]
+    lines.remove(line)
+    if not lines:
+        del breakpoints[file]
 
-    def add_breakpoint(file: str, line: int):
-        breakpoints.add(Breakpoint(file, line))
 
-    def remove_breakpoint(file: str, line: int):
-        breakpoints.remove(Breakpoint(file, line))
+# the same in every shell, only the frame changes
+shell_helpers = {"br": add_breakpoint,
+                 "rm": remove_breakpoint,
+                 "brs": breakpoints}
 
-    shell(_locals=frame.f_locals | {"frame": frame,
-                                    "br": add_breakpoint,
-                                    "rm": remove_breakpoint,
-                                    "brs": breakpoints},
-          _globals=frame.f_globals)
+
+def dbg_shell(frame: FrameType):
+    shell(_locals=frame.f_locals, _globals=frame.f_globals,
+          helpers={**shell_helpers, "frame": frame})
 
 
 def inner_handler(frame: FrameType, event: str, arg):
     if event != 'line':
         return
     line = frame.f_lineno
-    file = Path(frame.f_code.co_filename).stem
+    file = file_stem(frame.f_code.co_filename)
     if at_breakpoint(file, line):
         print(f"in break point at line {line}")
         dbg_shell(frame)
@@ -47,15 +64,24 @@ def inner_handler(frame: FrameType, event: str, arg):
 
 
 def at_breakpoint(file: str, line: int) -> bool:
-    return first_line or Breakpoint(file, line) in breakpoints
+    return first_line or line in breakpoints.get(file, _EMPTY)
+
+
+def has_breakpoint(code: CodeType) -> bool:
+    # line events are only needed for code with a breakpoint
+    file = file_stem(code.co_filename)
+    return any(at_breakpoint(file, line)
+               for _, _, line in code.co_lines() if line is not None)
 
 
 def handler(frame: FrameType, event: str, arg) \
         -> Optional[Callable[[FrameType, str, Any], None]]:
-    if 'presentation' not in frame.f_code.co_filename:
+    if frame.f_code.co_filename not in PRESENTATION_FILES:
         return
-    print(f"event: {event} {frame.f_code.co_name}")
-    return inner_handler
+    if LOG_EVENTS:
+        print(f"event: {event} {frame.f_code.co_name}")
+    if has_breakpoint(frame.f_code):
+        return inner_handler
 
 
 sys.settrace(handler)
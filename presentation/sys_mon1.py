@@ -1,89 +1,113 @@
 # initial PEP669 code
 import sys
-from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 from types import CodeType, FrameType
-from typing import Set
+from typing import Set, Dict, FrozenSet
 
-from util import shell
+from util import shell, file_stem
 
 
 def setup():
     # register the tool
     mon.use_tool_id(TOOL_ID, "dbg")
     # register callbacks for the events we are interested in
-    mon.register_callback(TOOL_ID, E.LINE, line_handler)
+    # the first line event opens a shell, and swaps in line_handler
+    mon.register_callback(TOOL_ID, E.LINE, first_line_handler)
     mon.register_callback(TOOL_ID, E.PY_START, start_handler)
     # enable PY_START event globally
     mon.set_events(TOOL_ID, E.PY_START)
 
 
-@dataclass(frozen=True)
-class Breakpoint:
-    file: str
-    line: int
+# file -> lines, so that checking a line doesn't create any objects
+breakpoints: Dict[str, Set[int]] = {}
+_EMPTY: FrozenSet[int] = frozenset()
 
 
-first_line = True
-breakpoints: Set[Breakpoint] = set()
+def add_breakpoint(file: str, line: int):
+    breakpoints.setdefault(file, set()).add(line)
+    # the line might have been disabled in line_handler
+    mon.restart_events()
 
 
-def dbg_shell(frame: FrameType):
-    global breakpoints
+# the same in every shell, only the frame changes
+shell_helpers = {"br": add_breakpoint,
+                 "brs": breakpoints}
 
-    def add_breakpoint(file: str, line: int):
-        breakpoints.add(Breakpoint(file, line))
 
-    shell(_locals=frame.f_locals | {"frame": frame,
-                                    "br": add_breakpoint,
-                                    "brs": breakpoints},
-          _globals=frame.f_globals)
+def dbg_shell(frame: FrameType):
+    shell(_locals=frame.f_locals, _globals=frame.f_globals,
+          helpers={**shell_helpers, "frame": frame})
 
 
 # some aliases and constants
 mon = sys.monitoring
 E = mon.events
 TOOL_ID = mon.DEBUGGER_ID
+# co_filename of the debugged file
+COUNTER_FILE = str(Path(__file__).with_name("counter.py").absolute())
+# print every event, the breakpoint hits are always printed
+LOG_EVENTS = False
 
 
 def enable_line_events(code: CodeType):
     mon.set_local_events(TOOL_ID, code, E.LINE)
 
 
-def has_breakpoint(file: str, start_line: int, length: int) -> bool:
-    return any(
-        br.file == file and br.line >= start_line and br.line <= start_line + length
-        for br in breakpoints)
+@lru_cache(maxsize=256)
+def code_lines(code: CodeType) -> FrozenSet[int]:
+    """ lines of the code object, computed once per code object """
+    return frozenset(line for _, _, line in code.co_lines()
+                     if line is not None)
+
+
+def has_breakpoint(file: str, code: CodeType) -> bool:
+    return not breakpoints.get(file, _EMPTY).isdisjoint(code_lines(code))
 
 
 def at_breakpoint(file: str, line: int) -> bool:
-    return first_line or Breakpoint(file, line) in breakpoints
+    return line in breakpoints.get(file, _EMPTY)
 
 
 first_call = True
 
 
 def line_handler(code: CodeType, line: int):
-    print(f"line {line} in {code.co_name}")
-    if at_breakpoint(code.co_name, line):
-        print(f"in break point at line {line}")
-        dbg_shell(sys._getframe(1))
+    if LOG_EVENTS:
+        print(f"line {line} in {code.co_name}")
+    if not at_breakpoint(file_stem(code.co_filename), line):
+        # don't call us again for this line, until restart_events
+        return mon.DISABLE
+    print(f"in break point at line {line}")
+    dbg_shell(sys._getframe(1))
+
+
+def first_line_handler(code: CodeType, line: int):
+    if LOG_EVENTS:
+        print(f"line {line} in {code.co_name}")
+    print(f"in break point at line {line}")
+    # all later line events go to line_handler
+    mon.register_callback(TOOL_ID, E.LINE, line_handler)
+    dbg_shell(sys._getframe(1))
 
 
 def start_handler(code: CodeType, _: int):
-    if not code.co_filename.endswith("counter.py"):
-        return
+    if code.co_filename != COUNTER_FILE:
+        # never report this code object again
+        return mon.DISABLE
     global first_call
     if first_call:
         first_call = False
         dbg_shell(sys._getframe(1))
         return
-    file = Path(code.co_filename).stem
-    if has_breakpoint(file, code.co_firstlineno,
-                      len(list(code.co_lines()))):
-        print(f"enable line events for {code.co_name}")
+    file = file_stem(code.co_filename)
+    # most files have no breakpoints, skip the lines for them
+    if file in breakpoints and has_breakpoint(file, code):
+        if LOG_EVENTS:
+            print(f"enable line events for {code.co_name}")
         enable_line_events(code)
-    print(f"start {code.co_name}")
+    if LOG_EVENTS:
+        print(f"start {code.co_name}")
 
 
 setup()
@@ -1,4 +1,6 @@
+import linecache
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 from types import FrameType
 
@@ -26,14 +28,16 @@ class ShellExit(Exception):
 
 
 def shell(_locals: dict = None, _globals: dict = None,
-          message: str = ""):
+          message: str = "", helpers: dict = None):
     import bpython
 
     def quit():
         raise SystemExit(ShellExit(exit_application=True))
 
-    local_vars = {'quit': quit} | (_locals or {}) | (
-                _globals or {})
+    # bpython needs a single dict, build it in one go,
+    # helpers shadow locals which shadow globals
+    local_vars = {'quit': quit, **(_globals or {}), **(_locals or {}),
+                  **(helpers or {})}
     ret = bpython.embed(locals_=local_vars, banner=message)
     if isinstance(ret, ShellExit):
         if ret.exit_application:
@@ -42,9 +46,14 @@ def shell(_locals: dict = None, _globals: dict = None,
         exit(ret)
 
 
+@lru_cache(maxsize=None)
+def file_stem(filename: str) -> str:
+    """ Path(filename).stem, computed once per file """
+    return Path(filename).stem
+
+
 def current_line(frame: FrameType) -> str:
-    path = Path(frame.f_code.co_filename)
-    if not path.exists():
-        return ""
-    return path.read_text().splitlines()[frame.f_lineno - 1]
+    # linecache reads each file only once, "" for missing files
+    return linecache.getline(frame.f_code.co_filename,
+                             frame.f_lineno).rstrip("\n")
 